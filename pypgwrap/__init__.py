@@ -1,6 +1,18 @@
 from connection import connection
 from connection import config_pool
+from connection import config_shards
 from context import ContextManager
+from pool import PoolOverloadError
+from profiler import Profiler
+from slowlog import SlowQueryLog
+from notify import NotificationDispatcher
+from typeregistry import TypeRegistry
+from writer import BufferedWriter
+from writer import BufferFullError
+from schema import SchemaCache
+from snapshot import SnapshotCache
+from budget import ConnectionBudget
+from budget import BudgetExhaustedError
 
 __author__ = 'Erick Almeida'
 version = "0.1.16"
@@ -124,9 +136,65 @@ __doc__ = """
         - max_pool: Maximum of connections created and mainteined in memory
         - pool_expiration: Idle time (in minutes) for close and destroy memory connection
         - url: Url with connection parameters
+        - profiler: Profiler used by all connections (see Profiling)
+        - slow_query_log: SlowQueryLog used by all connections (see Profiling)
+        - driver: Module/object providing connect() (defaults to psycopg2). The
+                  pypgwrap.fakedriver.FakeDriver returns canned rows without a
+                  database and is used by tests/benchmark_overhead.py
+        - lazy: Default for connection(lazy=...), see below
+        - cached_cursor: Default for connection(cached_cursor=...), see below
+        - statement_timeout: Default timeout (in seconds) for every statement
+        - priorities: Priority classes for connection(priority=...), as a dict of
+                      name -> {'reserved': n, 'queue': n, 'timeout': seconds}
+        - session_settings: Settings (name -> value, eg. {'search_path': 'app,public',
+                            'work_mem': '64MB'}) applied once per physical connection
+                            (a SET or RESET run on a pooled connection is kept)
+        - on_connect: Function called with each new physical connection (psycopg2
+                      connection), eg. to register types or run SET statements
+        - type_registry: TypeRegistry with the types (hstore, json loads, composite
+                         types, enums and their arrays) registered on each physical
+                         connection, with the OIDs resolved only once
+        - validate_after: Pooled connections idle for more than these seconds are
+                          validated on checkout and replaced if dead (None disables)
+        - validation: 'ping' (SELECT 1) or 'socket' (ping only when the socket has
+                      pending data, eg. the server closed it). Counts and time spent
+                      are available in get_pool().validation_stats
+        - schema: SchemaCache with the table metadata (columns and types, primary
+                  key, unique and foreign keys) loaded once from the catalogs, see
+                  the SQL API
+        - adaptive: Size the pool by demand, with max_pool as the hard ceiling, as a
+                    dict of options {'min_pool', 'target_wait', 'interval', 'step',
+                    'shrink_after', 'shrink_ratio'}, see below
+        - budget: ConnectionBudget limiting the physical connections of all the
+                  processes of the host, see below
 
     The intention of this method is to call at application start up, only!
 
+    With 'adaptive' the pool size starts at 'min_pool' and is reviewed every
+    'interval' seconds. A checkout finding the pool at its current size waits
+    up to 'target_wait' seconds and then takes a connection over the size (up
+    to max_pool); the size grows by 'step' (a fraction of it) after an
+    interval with such overflows, and shrinks by 'step' only after
+    'shrink_after' consecutive intervals with the peak usage below
+    'shrink_ratio' of the size, closing the idle connections above it.
+
+        >>> pypgwrap.config_pool(max_pool=100, url='postgres://localhost/',
+        ...                      adaptive={'min_pool': 5, 'target_wait': 0.02, 'interval': 10})
+        >>> get_pool().adaptive_state()
+        {'size': 12, 'ceiling': 100, 'in_use': 7, 'idle': 5, 'last_review': {'reason': 'hold', ...},
+         'decisions': [{'size': 8, 'new_size': 12, 'reason': 'grow: 3 over size, 0 rejected, ...', ...}, ...]}
+
+    Worker processes of the same host can share a ConnectionBudget, a counting
+    semaphore on a lock file keeping their physical connections under a
+    global cap (eg. below the server max_connections). Each process can use
+    up to max_pool connections while slots are free; a process short of
+    slots waits up to 'timeout' seconds (then BudgetExhaustedError) and makes
+    the other processes close their idle connections beyond 'reserve_idle',
+    so busy workers borrow the capacity of idle ones.
+
+        >>> budget = pypgwrap.ConnectionBudget('/run/app/pg.budget', limit=90, timeout=2.0)
+        >>> pypgwrap.config_pool(max_pool=20, url='postgres://localhost/', budget=budget)
+
     The connection class provides methods to return a cursor object or execute SQL queries
     directly (using an implicit cursor).
 
@@ -136,6 +204,58 @@ __doc__ = """
         commit          - Commit transaction (called implicitly on exiting context handler)
         rollback        - Rollback transaction
 
+    With connection(lazy=True) (or config_pool(lazy=True)) no pooled connection
+    is held until a statement runs. After each implicit call (db.select(...),
+    db.insert(...), ...) the connection goes back to the pool if it is in
+    autocommit or no transaction is open, and it is kept only while a
+    transaction is open, an explicit cursor was used (until commit/rollback)
+    or a statement was prepared (until close). Keyed connections are never lazy.
+
+    With connection(cached_cursor=True) implicit calls reuse one cursor (per
+    cursor factory) kept open until the connection is closed or released,
+    instead of opening and closing a cursor for every call.
+
+    Statements are cancelled by the server after 'statement_timeout' seconds
+    (connection(statement_timeout=...) or config_pool). The execute, query*,
+    select* and join* methods also accept a per call 'timeout'. The timeout is
+    sent as 'SET LOCAL statement_timeout' in the same round trip as the
+    statement, so inside an explicit transaction it stays in effect until the
+    transaction ends. A running statement can be interrupted from another
+    thread with connection.cancel().
+
+        >>> db.select('t1', where={'name__like': '%abc%'}, timeout=0.5)
+        >>> threading.Timer(1.0, db.cancel).start()
+        >>> db.execute('SELECT pg_sleep(10)')
+        QueryCanceledError: canceling statement due to user request
+
+    Priority classes keep latency-critical work running when the pool is
+    saturated. Each class has 'reserved' connections only it can use, and when
+    no connection is available up to 'queue' callers wait at most 'timeout'
+    seconds; beyond that PoolOverloadError is raised right away. Connections
+    without a configured class never wait (PoolError when exhausted).
+
+        >>> pypgwrap.config_pool(max_pool=20, url='postgres://localhost/',
+        ...                      priorities={'api': {'reserved': 5, 'queue': 100, 'timeout': 0.5},
+        ...                                  'batch': {'reserved': 0, 'queue': 2, 'timeout': 10}})
+        >>> db = pypgwrap.connection(priority='api')
+
+    Functions can also run in a transaction replayed on serialization
+    failures, deadlocks and lost connections (after failover), each attempt on
+    a fresh pooled connection and waiting a jittered exponential backoff:
+
+        >>> def transfer(tx):
+        ...     tx.update('account', {'balance__sub': 10}, {'id': 1})
+        ...     tx.update('account', {'balance__add': 10}, {'id': 2})
+        >>> db.run_in_transaction(transfer, isolation='serializable', retries=5, backoff=0.05)
+
+    Large purges can run in chunks, each one committed, so locks are held
+    briefly and WAL is written gradually. The deleted rows can be moved to an
+    archive table (with the same columns) by the same statement:
+
+        >>> db.delete_in_batches('t1', where={'created__lt': cutoff}, batch_size=5000, pause=0.1,
+        ...                      key='id', archive_to='t1_archive', progress=lambda deleted, chunks: log(deleted))
+        125000
+
     Cursor
     ------
 
@@ -157,6 +277,9 @@ __doc__ = """
         query_one       - execute SQL query and fetch first result
         query_dict      - execute SQL query and return results as dict
                           keyed on specified key (which should be unique)
+        query_as        - execute SQL query and return results as instances
+                          of a class (__slots__ class, namedtuple or any class
+                          taking the columns as keyword arguments)
 
     In addition the cursor can use the SQL API methods described below or
     access the underlying psycopg2 cursor (via the self.cursor attribute).
@@ -170,9 +293,12 @@ __doc__ = """
     The cursor class also provides a simple Python API for common SQL
     operations.  The basic methods provides are:
 
-        select          - single table select (with corresponding select_one, select_dict methods)
+        select          - single table select (with corresponding select_one, select_dict, select_as methods)
         join            - two table join (with corresponding join_one, join_dict methods)
         insert          - SQL insert
+        insert_many     - multi-row SQL insert (list of dicts)
+        count           - number of rows (approximate=True for the planner estimate)
+        exists          - whether any row matches
         update          - SQL update
         delete          - SQL delete
 
@@ -206,6 +332,33 @@ __doc__ = """
 
         returning       - columns to return (string)
 
+        group_by        - GROUP BY columns (select methods only)
+
+                          group_by = ('name',)
+
+        having          - 'having' clause as dict, in the same format as
+                          'where' (select methods only)
+
+                          having = {sqlop.aggregate('count') + '__gt': 1}
+
+    With config_pool(schema=pypgwrap.SchemaCache(ttl=300)) the table metadata
+    is read from the catalogs once (per 'ttl' seconds) and used by check_table,
+    by insert/insert_many/update to reject unknown columns before the round
+    trip and cast the values to the column types, and by join to take the
+    default 'on' condition from the foreign keys. table_info returns it:
+
+        >>> db.table_info('t2').foreign_keys
+        [(('t1_id',), 16385, ('id',))]
+
+    Aggregate columns can be built with sqlop.aggregate(function, field,
+    distinct, order_by):
+
+        >>> from pypgwrap import sqlop
+        >>> db.select('t2',columns=('t1_id',(sqlop.aggregate('count'),'n'),
+        ...                         (sqlop.aggregate('array_agg','value',order_by='id'),'values')),
+        ...           group_by=('t1_id',),having={sqlop.aggregate('count')+'__gt':1})
+        SELECT t1_id, count(*) AS n, array_agg(value ORDER BY id) AS values FROM t2 GROUP BY t1_id HAVING count(*) > 1
+
     The methods are also available as standalone functions which create an
     implicit cursor object.
 
@@ -276,6 +429,108 @@ __doc__ = """
         >>> p(1,'xxx')
         EXECUTE _pstmt_001 (1,'xxx')
 
+    Concurrent queries
+    ------------------
+
+        Independent queries can be fanned out across pooled connections using
+
+            connection.gather(calls, workers)
+
+            calls     : list of (method, args[, kwargs]) tuples
+            workers   : maximum number of concurrent connections (defaults
+                        to the pool 'max_pool')
+
+        Each worker checks out its own connection (never a keyed one) and the
+        results are returned in the same order as the calls.
+
+        >>> db.gather([('select', ('t1',)), ('query_one', ('select count(*) from t2',))])
+        [[[1, 'xyz', 1]], [1]]
+
+        Large tables can be streamed in parallel using
+
+            connection.select_parallel(table, partition_key, workers, where, columns, preserve_order)
+
+        The 'partition_key' range is split into 'workers' ranges (using min/max
+        for integer keys and percentiles otherwise), each one read through a
+        server-side cursor on its own pooled connection. Rows are yielded as
+        they arrive, or in key order when 'preserve_order' is set.
+
+        >>> for row in db.select_parallel('t1', 'id', workers=4):
+        ...     export(row)
+
+    Notifications
+    -------------
+
+        NotificationDispatcher listens on channels using one dedicated
+        connection (outside the pool), waiting on its socket so no queries or
+        CPU are spent while idle. Notifications are delivered to callbacks or
+        queues registered per channel, and the dispatcher reconnects and
+        listens again after a connection failure.
+
+        >>> dispatcher = pypgwrap.NotificationDispatcher(batch_window=0.05)
+        >>> dispatcher.start()
+        >>> queue = dispatcher.listen('t1_changed')
+        >>> dispatcher.listen('t1_changed', lambda notifies: cache.clear(), batch=True)
+        >>> db.execute("NOTIFY t1_changed, 'abc'")
+        >>> queue.get(timeout=1).payload
+        'abc'
+        >>> dispatcher.stop()
+
+    Sharding
+    --------
+
+        Data partitioned across several databases can use one pool per shard,
+        configured with config_shards (other parameters as in config_pool):
+
+            >>> pypgwrap.config_shards({'s0': 'postgres://db0/app', 's1': 'postgres://db1/app'},
+            ...                        shard_key=lambda customer_id: 's%d' % (customer_id % 2),
+            ...                        max_pool=10)
+            >>> db = pypgwrap.connection(shard_key=customer_id)   # or connection(shard='s1')
+
+        The pypgwrap.shard module runs queries on all shards concurrently and
+        merges the results, optionally sorted (same format as 'order') with
+        limit/offset applied to the merged rows (select_all also pushes the
+        limit down to each shard):
+
+            >>> from pypgwrap import shard
+            >>> shard.select_all('t1', where={'active': True}, order=('name',), limit=10)
+            >>> shard.query_all('SELECT name, count(*) AS n FROM t1 GROUP BY name', order=('n__desc',))
+            >>> shard.scatter('query_one', 'SELECT count(*) FROM t1')
+            {'s0': [10], 's1': [12]}
+
+    Buffered writes
+    ---------------
+
+        High volume writes (telemetry, audit) can be moved off the request path
+        with a BufferedWriter bound to a table. write() only queues the row and
+        a background thread inserts the rows in bulk (multi-row INSERT or COPY)
+        every 'batch_size' rows or 'flush_interval' seconds. When 'max_buffer'
+        rows are waiting, write() blocks up to 'block_timeout' seconds and then
+        raises BufferFullError. Failed batches are passed to 'on_error', and
+        the queued rows are flushed on close() and at interpreter exit.
+
+        >>> writer = pypgwrap.BufferedWriter('t2', batch_size=1000, flush_interval=0.5, method='copy',
+        ...                                  on_error=lambda rows, exc_info: log.error('lost %d rows', len(rows)))
+        >>> writer.write({'t1_id': 1, 'value': 'abc'})
+        >>> writer.close()
+
+    Snapshots
+    ---------
+
+        Reference data read by every worker process can be served from
+        SnapshotCache files: the rows of a query are written once to a compact
+        file in 'directory' and memory mapped by all the processes of the
+        host, so a new worker does not query the database to get them. Each
+        snapshot is validated with its 'version' query (eg. max(updated_at))
+        on first use and by a background thread every 'refresh_interval'
+        seconds, and rebuilt by a single process when the version changes.
+
+        >>> cache = pypgwrap.SnapshotCache('/var/cache/app', refresh_interval=30)
+        >>> cache.register('t1', 'SELECT * FROM t1', key='id', version='SELECT max(id) FROM t1')
+        >>> cache.start()
+        >>> cache.get('t1')[1]
+        {'id': 1, 'name': 'abc', 'count': 0}
+
     Logging
     -------
 
@@ -293,6 +548,32 @@ __doc__ = """
         >>> db.query('SELECT * FROM t1')
         [0.000536] SELECT * FROM t1
 
+    Profiling
+    ---------
+
+        A Profiler aggregates statement statistics by fingerprint (statement
+        with literals and parameters stripped): call count, total/p50/p99
+        latency, rows and fetched bytes. It can be set for all connections in
+        config_pool or per connection, and only a 'sample_rate' fraction of the
+        statements is measured to keep the overhead bounded.
+
+        >>> profiler = pypgwrap.Profiler(sample_rate=0.1)
+        >>> pypgwrap.config_pool(max_pool=10, url='postgres://localhost/', profiler=profiler)
+        >>> profiler.top(5)
+        [{'fingerprint': 'SELECT * FROM t1 WHERE id = ?', 'calls': 10, 'total_time': 0.0042, ...}]
+        >>> profiler.reset()
+
+        A SlowQueryLog records the plan of statements slower than a threshold
+        (in seconds). The plan is collected asynchronously running
+        EXPLAIN (FORMAT JSON) on a separate connection of the pool (or shard)
+        the statement ran on, optionally with ANALYZE (always rolled back),
+        and the last 'size' distinct fingerprints are kept.
+
+        >>> slow_log = pypgwrap.SlowQueryLog(threshold=0.5, size=50, analyze=False)
+        >>> pypgwrap.config_pool(max_pool=10, url='postgres://localhost/', slow_query_log=slow_log)
+        >>> slow_log.entries()[0]
+        {'fingerprint': 'SELECT * FROM t1 WHERE name LIKE ?', 'count': 3, 'duration': 0.92, 'plan': [...], ...}
+
     Changelog
     ---------
 
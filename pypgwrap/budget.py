@@ -0,0 +1,187 @@
+__author__ = 'Erick Almeida'
+
+import errno
+import os
+import threading
+import time
+import weakref
+from psycopg2.pool import PoolError
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+
+class BudgetExhaustedError(PoolError):
+    """Raised when no host-wide connection slot is free within the budget timeout."""
+
+
+class _SlotFile(object):
+    """
+        The budget file of a path, opened once per process. Record locks
+        belong to the process: two descriptors of the same file would both
+        get the same slot, and closing either one drops the locks of both.
+    """
+
+    def __init__(self, path):
+        self.pid = os.getpid()
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+        self.held = set()  # slots locked by any budget of this process
+        self.lock = threading.Lock()
+
+
+_files = {}  # real path -> _SlotFile
+_files_lock = threading.Lock()
+
+
+def _slot_file(path):
+    key = os.path.realpath(path)
+    with _files_lock:
+        slots = _files.get(key)
+        # record locks are not inherited by fork(): a child starts with no slots
+        if slots is None or slots.pid != os.getpid():
+            slots = _files[key] = _SlotFile(path)
+        return slots
+
+
+class ConnectionBudget(object):
+    """
+        Host-wide limit of physical connections, shared by every process (and
+        pool) using the same 'path'. Each connection holds one of 'limit'
+        slots, a byte range lock (fcntl) on the budget file, so the slots of a
+        process that dies are released by the kernel. Budgets of the same path
+        in one process share its slots.
+
+        A process needing a slot while all are taken waits up to 'timeout'
+        seconds and flags the shortage in the '<path>.pressure' file. Every
+        process checks the flag each 'check_interval' seconds (from a daemon
+        thread) and closes its idle pooled connections beyond 'reserve_idle'
+        per pool, so busy processes borrow the capacity idle ones are not
+        using. Without shortage, idle connections stay pooled as usual. Not
+        available on Windows, which has no fcntl.
+
+        >>> budget = ConnectionBudget('/run/app/pg.budget', limit=90, timeout=2.0)
+        >>> pypgwrap.config_pool(max_pool=20, url='postgres://localhost/', budget=budget)
+        >>> budget.stats
+        {'acquired': 14, 'released': 2, 'waits': 1, 'wait_time': 0.08, 'exhausted': 0, 'trimmed': 3}
+    """
+
+    def __init__(self, path, limit, timeout=1.0, reserve_idle=1, check_interval=1.0):
+        if fcntl is None:
+            raise NotImplementedError('ConnectionBudget needs fcntl file locks')
+        self.path = path
+        self.limit = limit
+        self.timeout = timeout
+        self.reserve_idle = reserve_idle
+        self.check_interval = check_interval
+        self.pressure_path = path + '.pressure'
+        self.stats = {'acquired': 0, 'released': 0, 'waits': 0, 'wait_time': 0.0, 'exhausted': 0, 'trimmed': 0}
+        self._lock = threading.Lock()
+        self._pools = weakref.WeakSet()
+        self._thread = None
+        self._pid = None
+        self._file = None
+        self._held = set()
+
+    def _slots(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._file = _slot_file(self.path)
+                self._held = set()
+                self._thread = None
+            if self._thread is None and self._pools:
+                self._thread = threading.Thread(target=self._run, name='ConnectionBudget')
+                self._thread.daemon = True
+                self._thread.start()
+            return self._file
+
+    def try_acquire(self):
+        """Take a free slot without waiting; None if all are taken."""
+        slots = self._slots()
+        with slots.lock:
+            first = self._pid % self.limit
+            for i in range(self.limit):
+                slot = (first + i) % self.limit
+                if slot in slots.held:
+                    # locks are per process, locking a held slot again would succeed
+                    continue
+                try:
+                    fcntl.lockf(slots.fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, slot)
+                except IOError as e:
+                    if e.errno not in (errno.EACCES, errno.EAGAIN):
+                        raise
+                    continue
+                slots.held.add(slot)
+                self._held.add(slot)
+                self.stats['acquired'] += 1
+                return slot
+        return None
+
+    def acquire(self):
+        """Take a free slot, waiting up to 'timeout' seconds; raises BudgetExhaustedError."""
+        slot = self.try_acquire()
+        if slot is not None:
+            return slot
+        start = time.time()
+        self.stats['waits'] += 1
+        delay = 0.005
+        try:
+            while True:
+                self._signal_pressure()
+                remaining = start + self.timeout - time.time()
+                if remaining <= 0:
+                    self.stats['exhausted'] += 1
+                    raise BudgetExhaustedError('connection budget exhausted ({limit} connections in {path})'.format(
+                        limit=self.limit, path=self.path))
+                time.sleep(min(delay, remaining))
+                delay = min(delay * 2, 0.1)
+                slot = self.try_acquire()
+                if slot is not None:
+                    return slot
+        finally:
+            self.stats['wait_time'] += time.time() - start
+
+    def release(self, slot):
+        slots = self._slots()
+        with slots.lock:
+            if slot not in self._held:
+                return
+            fcntl.lockf(slots.fd, fcntl.LOCK_UN, 1, slot)
+            slots.held.discard(slot)
+            self._held.discard(slot)
+            self.stats['released'] += 1
+
+    def held(self):
+        """Number of slots held by this budget in this process."""
+        return len(self._held) if self._pid == os.getpid() else 0
+
+    def register(self, pool):
+        """Trim the idle connections of 'pool' when other processes are short of slots."""
+        self._pools.add(pool)
+        self._slots()
+
+    def under_pressure(self):
+        try:
+            return time.time() - os.stat(self.pressure_path).st_mtime < 2 * self.check_interval
+        except OSError:
+            return False
+
+    def _signal_pressure(self):
+        try:
+            with open(self.pressure_path, 'a'):
+                os.utime(self.pressure_path, None)
+        except (IOError, OSError):
+            pass
+
+    def _run(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(self.check_interval)
+            if self.under_pressure():
+                for pool in list(self._pools):
+                    try:
+                        self.stats['trimmed'] += pool.release_idle(self.reserve_idle)
+                    except PoolError:
+                        pass
@@ -3,15 +3,30 @@ import ast
 __author__ = 'Erick Almeida'
 
 import os
+import random
+import sys
+import threading
+import time
+import Queue
+import zlib
 from collections import namedtuple
 from psycopg2.extras import DictCursor, NamedTupleCursor
 import psycopg2.extensions as _ext
+import sqlop
 from pool import SimpleConnectionPool, ThreadedConnectionPool
 from cursor import cursor, PreparedStatement
-from psycopg2 import OperationalError
+from psycopg2 import OperationalError, InterfaceError
+from psycopg2.extensions import TransactionRollbackError, QueryCanceledError
 from psycopg2.pool import PoolError
 
 __connection_pool__ = ThreadedConnectionPool()
+__shard_pools__ = {}
+__shard_function__ = None
+
+_isolation_levels = {'read uncommitted': 'READ UNCOMMITTED',
+                     'read committed': 'READ COMMITTED',
+                     'repeatable read': 'REPEATABLE READ',
+                     'serializable': 'SERIALIZABLE'}
 
 
 class SafeNamedTupleCursor(NamedTupleCursor):
@@ -19,41 +34,110 @@ class SafeNamedTupleCursor(NamedTupleCursor):
         return namedtuple("Record", [d[0] for d in self.description or ()], rename=True)
 
 
-def config_pool(max_pool=5, pool_expiration=5, url=None, pool_manager=ThreadedConnectionPool):
+def config_pool(max_pool=5, pool_expiration=5, url=None, pool_manager=ThreadedConnectionPool, profiler=None,
+                slow_query_log=None, driver=None, lazy=False, statement_timeout=None, priorities=None,
+                session_settings=None, on_connect=None, type_registry=None, cached_cursor=False,
+                validate_after=None, validation='ping', schema=None, adaptive=None, budget=None):
+    global __connection_pool__
+    __connection_pool__ = _build_pool(max_pool, pool_expiration, url or os.environ.get('DATABASE_URL'), pool_manager,
+                                      profiler, slow_query_log, driver, lazy, statement_timeout, priorities,
+                                      session_settings, on_connect, type_registry, cached_cursor, validate_after,
+                                      validation, schema, adaptive, budget)
+
+
+def config_shards(shards, shard_key=None, **kwargs):
+    """
+        Configure one pool per shard, from a dict of shard name -> url. The
+        other parameters are the same of config_pool and apply to every shard.
+
+        'shard_key' maps the value given to connection(shard_key=...) to a
+        shard name; by default a stable hash of the value selects one of the
+        shards (sorted by name).
+    """
+    global __shard_pools__, __shard_function__
+    pools = {}
+    for name, url in shards.items():
+        pools[name] = _build_pool(url=url, **kwargs)
+    names = sorted(pools)
+    __shard_pools__ = pools
+    __shard_function__ = shard_key or (lambda value: names[zlib.crc32(str(value)) % len(names)])
+
+
+def _build_pool(max_pool=5, pool_expiration=5, url=None, pool_manager=ThreadedConnectionPool, profiler=None,
+                slow_query_log=None, driver=None, lazy=False, statement_timeout=None, priorities=None,
+                session_settings=None, on_connect=None, type_registry=None, cached_cursor=False,
+                validate_after=None, validation='ping', schema=None, adaptive=None, budget=None):
     import urlparse
 
-    params = urlparse.urlparse(url or os.environ.get('DATABASE_URL') or 'postgres://localhost/')
-    global __connection_pool__
-    __connection_pool__ = pool_manager()
-    __connection_pool__.configure(expiration=pool_expiration,
-                                  maxconn=max_pool,
-                                  database=params.path[1:],
-                                  user=params.username,
-                                  password=params.password,
-                                  host=params.hostname,
-                                  port=params.port)
+    params = urlparse.urlparse(url or 'postgres://localhost/')
+    pool = pool_manager()
+    pool.configure(expiration=pool_expiration,
+                   maxconn=max_pool,
+                   database=params.path[1:],
+                   user=params.username,
+                   password=params.password,
+                   host=params.hostname,
+                   port=params.port)
+    pool.profiler = profiler
+    pool.slow_query_log = slow_query_log
+    if driver is not None:
+        pool.driver = driver
+    pool.lazy = lazy
+    pool.statement_timeout = statement_timeout
+    pool.cached_cursor = cached_cursor
+    pool.configure_priorities(priorities)
+    pool.configure_session(session_settings, on_connect, type_registry)
+    pool.configure_validation(validate_after, validation)
+    pool.schema = schema
+    pool.configure_adaptive(adaptive)
+    pool.configure_budget(budget)
+    return pool
 
 
-def get_pool():
+def get_pool(shard=None):
     global __connection_pool__
+    if shard is not None:
+        return __shard_pools__[shard]
     return __connection_pool__
 
 
+def get_shards():
+    """Return the configured shard names."""
+    return sorted(__shard_pools__)
+
+
+def shard_for(value):
+    """Return the shard name for a shard key value."""
+    return __shard_function__(value)
+
+
 class connection(object):
-    def __init__(self, hstore=False, log=None, logf=None, default_cursor=DictCursor, key=None):
-        self.pool = get_pool()
+    def __init__(self, hstore=False, log=None, logf=None, default_cursor=DictCursor, key=None, profiler=None,
+                 slow_query_log=None, lazy=None, statement_timeout=None, priority=None, cached_cursor=None,
+                 shard=None, shard_key=None):
+        if shard is None and shard_key is not None:
+            shard = shard_for(shard_key)
+        self.shard = shard
+        self.pool = get_pool(shard)
         self.key = key
+        self.priority = priority
         self.close_on_exit = ast.literal_eval(os.getenv('PYPGWRAP_CLOSE_CONNECTION_ON_EXIT', "False"))
         self.closed = False
-        try:
-            self.connection = self.pool.getconn(self.key)
-        except (PoolError, OperationalError) as e:
-            self.connection = None
-            raise e
+        self.connection = None
+        self.lazy = self.pool.lazy if lazy is None else lazy
+        self.pinned = False  # prepared statements, until close
+        self.cursor_pinned = False  # explicit cursors, until commit/rollback
+        self.cached_cursor = self.pool.cached_cursor if cached_cursor is None else cached_cursor
+        self._cursors = {}  # cursor_factory -> cursor reused by implicit calls
+        if not self.lazy or self.key:
+            self._acquire()
         self.hstore = hstore
         self.log = log
         self.logf = logf or (lambda cursor: cursor.query)
         self.default_cursor = default_cursor
+        self.profiler = profiler or self.pool.profiler
+        self.slow_query_log = slow_query_log or self.pool.slow_query_log
+        self.statement_timeout = self.pool.statement_timeout if statement_timeout is None else statement_timeout
         self.prepared_statement_id = 0
 
     def prepare(self, statement, params=None, name=None, call_type=None):
@@ -77,7 +161,9 @@ class connection(object):
             params = '(' + ','.join(params) + ')'
         else:
             params = ''
-        with self.cursor() as c:
+        # prepared statements live in the session, keep it while this connection is open
+        self.pinned = True
+        with self._cursor() as c:
             c.execute('PREPARE %s %s AS %s' % (name, params, statement))
         if call_type is None:
             if statement.lower().startswith('select'):
@@ -86,19 +172,360 @@ class connection(object):
                 call_type = 'execute'
         return PreparedStatement(self, name, call_type)
 
-    def cursor(self, cursor_factory=None):
-        return cursor(self.connection,
+    def _acquire(self):
+        """Borrow the pooled connection, if not already held."""
+        if self.connection is None:
+            try:
+                self.connection = self.pool.getconn(self.key, priority=self.priority)
+            except (PoolError, OperationalError) as e:
+                self.connection = None
+                raise e
+            self.closed = False
+        return self.connection
+
+    def _release(self):
+        """Give a lazy connection back to the pool when no transaction is open."""
+        conn = self.connection
+        if self.lazy and not self.key and not self.pinned and not self.cursor_pinned and conn is not None and \
+                (conn.autocommit or conn.get_transaction_status() == _ext.TRANSACTION_STATUS_IDLE):
+            self._close_cursors()
+            self.connection = None
+            self.closed = True
+            self.pool.putconn(conn, close=self.close_on_exit)
+
+    def _implicit_cursor(self):
+        """Return the cursor kept open for implicit calls, in cached_cursor mode."""
+        c = self._cursors.get(self.default_cursor)
+        if c is None or c.connection is not self._acquire():
+            c = self._cursor().__enter__()
+            self._cursors[self.default_cursor] = c
+        else:
+            c.log = self.log
+            c.logf = self.logf
+            c.profiler = self.profiler
+            c.slow_query_log = self.slow_query_log
+            c.timeout = self.statement_timeout
+        return c
+
+    def _close_cursors(self):
+        cursors, self._cursors = self._cursors, {}
+        for c in cursors.values():
+            try:
+                c.__exit__(None, None, None)
+            except Exception:
+                pass
+
+    def cursor(self, cursor_factory=None, name=None):
+        # the explicit cursor may outlive the next implicit call, keep the connection until commit/rollback
+        self.cursor_pinned = True
+        return self._cursor(cursor_factory, name)
+
+    def _cursor(self, cursor_factory=None, name=None):
+        return cursor(self._acquire(),
                       cursor_factory or self.default_cursor,
                       self.hstore,
                       self.log,
-                      self.logf)
+                      self.logf,
+                      name,
+                      self.profiler,
+                      self.slow_query_log,
+                      self.statement_timeout,
+                      self.pool.schema,
+                      self.pool)
 
     def __getattr__(self, name):
-        def _wrapper(*args, **kwargs):
-            with self.cursor() as c:
-                return getattr(c, name)(*args, **kwargs)
+        # the public cursor methods are installed at import time (see below)
+        return _implicit(name).__get__(self, connection)
+
+    def gather(self, calls, workers=None):
+        """
+            Run independent calls concurrently, each worker on its own pooled
+            connection. Calls are tuples (method, args[, kwargs]) and results
+            are returned in the same order. Connections are never borrowed
+            from a keyed transaction and no more than the available pool
+            capacity (up to 'workers' or 'maxconn') is used.
+
+            >>> db = connection()
+            >>> db.gather([('query_one', ('select 1',)),
+            ...            ('select_one', ('doctest_t1',), {'columns': ('name',), 'order': ('name',)})])
+            [[1], ['aaaaa']]
+        """
+        calls = list(calls)
+        results = [None] * len(calls)
+        if not calls:
+            return results
+        connections = self._checkout_many(min(len(calls), workers or self.pool.maxconn))
+
+        pending = Queue.Queue()
+        for item in enumerate(calls):
+            pending.put(item)
+        errors = []
+
+        def _worker(db):
+            try:
+                while True:
+                    try:
+                        i, call = pending.get_nowait()
+                    except Queue.Empty:
+                        return
+                    name, args, kwargs = tuple(call) + ((), {})[len(call) - 1:]
+                    try:
+                        results[i] = getattr(db, name)(*args, **kwargs)
+                    except Exception:
+                        errors.append((i, sys.exc_info()))
+            finally:
+                db.close()
+
+        threads = [threading.Thread(target=_worker, args=(db,)) for db in connections]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            _, exc_info = min(errors)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return results
+
+    def select_parallel(self, table, partition_key='id', workers=4, where=None, columns=None,
+                        preserve_order=False, itersize=1000):
+        """
+            Stream a table split into 'workers' ranges of 'partition_key'. Each
+            range is read through a server-side cursor on its own pooled
+            connection and rows are yielded as they arrive (or in key order
+            when 'preserve_order' is set). Rows with a NULL key are skipped.
+
+            >>> db = connection()
+            >>> rows = db.select_parallel('doctest_t1', 'id', workers=3, columns=('name',), preserve_order=True)
+            >>> [r['name'] for r in rows][:3]
+            ['aaaaa', 'bbbbb', 'ccccc']
+        """
+        connections = self._checkout_many(workers)
+        edges = []
+        try:
+            edges = _partition_edges(connections[0], table, partition_key, where, len(connections))
+        finally:
+            for db in connections[len(edges):]:
+                db.close()
+        connections = connections[:len(edges)]
+        if not edges:
+            return
+
+        order = (partition_key,) if preserve_order else None
+        stop = threading.Event()
+
+        def _put(queue, item):
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return
+                except Queue.Full:
+                    pass
+
+        def _worker(db, range_where, queue):
+            autocommit = db.connection.autocommit
+            try:
+                db.connection.autocommit = False
+                with db.cursor(name='_pypgwrap_parallel') as c:
+                    c.cursor.itersize = itersize
+                    c.execute(c._build_select(table, range_where, order, columns, None, None, False), range_where)
+                    while not stop.is_set():
+                        rows = c.cursor.fetchmany(itersize)
+                        if not rows:
+                            break
+                        _put(queue, ('rows', rows))
+                _put(queue, ('done', None))
+            except Exception:
+                _put(queue, ('error', sys.exc_info()))
+            finally:
+                try:
+                    db.connection.rollback()
+                    db.connection.autocommit = autocommit
+                except Exception:
+                    pass
+                db.close()
+
+        if preserve_order:
+            queues = [Queue.Queue(maxsize=2) for _ in edges]
+            feeds = [(q, 1) for q in queues]
+        else:
+            queues = [Queue.Queue(maxsize=2 * len(edges))] * len(edges)
+            feeds = [(queues[0], len(edges))]
+
+        threads = []
+        for i, lower in enumerate(edges):
+            range_where = dict(where or {})
+            range_where[partition_key + '__>='] = lower
+            if i + 1 < len(edges):
+                range_where[partition_key + '__<'] = edges[i + 1]
+            t = threading.Thread(target=_worker, args=(connections[i], range_where, queues[i]))
+            t.daemon = True
+            threads.append(t)
+        try:
+            for t in threads:
+                t.start()
+            for queue, pending in feeds:
+                while pending:
+                    kind, value = queue.get()
+                    if kind == 'done':
+                        pending -= 1
+                    elif kind == 'error':
+                        raise value[0], value[1], value[2]
+                    else:
+                        for row in value:
+                            yield row
+        finally:
+            stop.set()
+            for t in threads:
+                if t.is_alive():
+                    t.join()
+
+    def _fork(self):
+        """Check out a new unkeyed, non lazy connection with the settings of this one."""
+        return connection(self.hstore, self.log, self.logf, self.default_cursor, profiler=self.profiler,
+                          slow_query_log=self.slow_query_log, lazy=False, statement_timeout=self.statement_timeout,
+                          priority=self.priority, shard=self.shard)
+
+    def run_in_transaction(self, fn, isolation=None, retries=3, backoff=0.05, max_backoff=2.0):
+        """
+            Call fn(db) inside a transaction on a fresh pooled connection and
+            commit. On serialization failures, deadlocks or lost connections
+            the transaction is rolled back and fn is replayed (up to 'retries'
+            times) on another connection after a jittered exponential backoff
+            starting at 'backoff' seconds. Broken connections are discarded
+            from the pool.
+
+            >>> db = connection()
+            >>> db.run_in_transaction(lambda tx: tx.update('doctest_t1', {'count__add': 1}, {'name': 'aaaaa'}),
+            ...                       isolation='serializable')
+            1
+            >>> db.update('doctest_t1', {'count__sub': 1}, {'name': 'aaaaa'})
+            1
+        """
+        level = None
+        if isolation:
+            level = _isolation_levels.get(isolation.lower().replace('_', ' '))
+            if level is None:
+                raise ValueError('unknown isolation level %s' % isolation)
+        for attempt in range(retries + 1):
+            tx = None
+            try:
+                # connecting may fail too, eg. right after a failover
+                tx = self._fork()
+                conn = tx.connection
+                autocommit = conn.autocommit
+                conn.autocommit = False
+                try:
+                    if level:
+                        tx.execute('SET TRANSACTION ISOLATION LEVEL %s' % level)
+                    result = fn(tx)
+                    conn.commit()
+                    return result
+                except Exception:
+                    if not conn.closed:
+                        try:
+                            conn.rollback()
+                        except (OperationalError, InterfaceError):
+                            pass
+                    raise
+                finally:
+                    if not conn.closed:
+                        try:
+                            conn.autocommit = autocommit
+                        except (OperationalError, InterfaceError):
+                            pass
+            except (TransactionRollbackError, OperationalError, InterfaceError) as e:
+                if isinstance(e, QueryCanceledError) or attempt == retries:
+                    raise
+                if tx is not None and (conn.closed or not isinstance(e, TransactionRollbackError)):
+                    # the connection may be broken, do not give it back to the pool
+                    tx.close_on_exit = True
+            finally:
+                if tx is not None:
+                    tx.close()
+            time.sleep(random.uniform(0, min(max_backoff, backoff * 2 ** attempt)))
+
+    def delete_in_batches(self, table, where=None, batch_size=1000, pause=0.0, archive_to=None, key='ctid',
+                          progress=None, timeout=None):
+        """
+            Delete the rows of 'table' matching 'where' in chunks of at most
+            'batch_size' rows, committing after each chunk and sleeping 'pause'
+            seconds between chunks, so locks are held briefly and WAL is written
+            gradually. Chunks are picked by physical row id ('ctid'), or by
+            'key' (eg. the primary key) in key order. With 'archive_to' the
+            deleted rows are inserted into that table (with the same columns)
+            by the same statement. progress(deleted, chunks) is called after
+            each chunk. Keyed connections run it on a separate connection;
+            on unkeyed ones the first commit also commits the transaction
+            already open on the connection. Returns the number of deleted rows.
+
+            >>> db = connection()
+            >>> db.insert_many('doctest_t1',[{'name':'del%d' % i} for i in range(5)])
+            5
+            >>> db.delete_in_batches('doctest_t1',where={'name__like':'del%'},batch_size=2,key='id')
+            5
+        """
+        conditions = sqlop.where(where)[len(' WHERE '):]
+        returning = '*' if archive_to else key
+        db = self._fork() if self.key else self
+        params = dict(where or {})
+        deleted = chunks = 0
+        try:
+            while True:
+                if key == 'ctid':
+                    picked = 'SELECT ctid FROM %s%s LIMIT %d' % (table, sqlop.where(params), batch_size)
+                    chunk = 'ctid = ANY(ARRAY(SELECT ctid FROM picked))'
+                else:
+                    # keyset pagination (params has key__gt after the first chunk), deleted keys are not scanned
+                    picked = 'SELECT %s FROM %s%s ORDER BY %s LIMIT %d' % (key, table, sqlop.where(params), key,
+                                                                         batch_size)
+                    chunk = '%s IN (SELECT %s FROM picked)' % (key, key)
+                # the conditions are checked again on rows changed since the chunk was picked
+                sql = 'WITH picked AS (%s), deleted AS (DELETE FROM %s WHERE %s%s RETURNING %s)' % (
+                    picked, table, chunk, ' AND ' + conditions if conditions else '', returning)
+                if archive_to:
+                    sql += ', archived AS (INSERT INTO %s SELECT * FROM deleted)' % archive_to
+                sql += ' SELECT (SELECT count(*) FROM picked), (SELECT count(*) FROM deleted)'
+                if key != 'ctid':
+                    sql += ', (SELECT max(%s) FROM picked)' % key
+                row = db.query_one(sql, params, timeout)
+                db.commit()
+                # rows failing the check again are left out of the chunk, stop only when none was picked
+                if not row[0]:
+                    return deleted
+                deleted += row[1]
+                chunks += 1
+                if progress:
+                    progress(deleted, chunks)
+                if key != 'ctid':
+                    params[key + '__gt'] = row[2]
+                if pause:
+                    time.sleep(pause)
+        finally:
+            if db is not self:
+                db.close()
 
-        return _wrapper
+    def _checkout_many(self, count):
+        """Check out up to 'count' unkeyed connections, as many as the pool allows."""
+        count = max(1, min(count, self.pool.maxconn))
+        connections = []
+        try:
+            while len(connections) < count:
+                connections.append(self._fork())
+        except (PoolError, OperationalError):
+            if not connections:
+                raise
+        return connections
+
+    def cancel(self):
+        """
+            Cancel the statement running on this connection. Safe to call from
+            another thread; the interrupted call raises QueryCanceledError and
+            an aborted transaction is rolled back when the connection goes
+            back to the pool.
+        """
+        conn = self.connection
+        if conn is not None:
+            conn.cancel()
 
     def commit(self, context_transaction=False):
         if self.connection:
@@ -106,20 +533,29 @@ class connection(object):
                 raise Exception(
                     'Connection was associated with Connection Context. Commits are not allowed. Use context_transaction if you want do it.')
             self.connection.commit()
+            self.cursor_pinned = False
+            self._release()
 
     def rollback(self, context_transaction=False):
         if self.connection:
             if self.key and not context_transaction:
                 raise Exception('Connection was associated with Connection Context. Rollbacks are not allowed.')
             self.connection.rollback()
+            self.cursor_pinned = False
+            self._release()
 
     def close(self, context_transaction=False):
         if self.connection:
             if self.key and not context_transaction:
                 raise Exception(
                     'Connection was associated with Connection Context. Commits are not allowed. Use context_transaction if you want do it.')
+            self._close_cursors()
             self.pool.putconn(self.connection, close=self.close_on_exit)
             self.closed = True
+            if self.lazy:
+                self.connection = None
+                self.pinned = False
+                self.cursor_pinned = False
 
     def __enter__(self, name=None):
         return self
@@ -134,5 +570,46 @@ class connection(object):
 
     def __del__(self):
         if not self.key and self.connection and not self.closed:
+            self._close_cursors()
             conn = self.connection
             self.pool.putconn(conn, close=self.close_on_exit)
+
+
+def _implicit(name):
+    """Build the connection method running cursor method 'name' in an implicit cursor."""
+    def _wrapper(self, *args, **kwargs):
+        try:
+            if self.cached_cursor:
+                try:
+                    return getattr(self._implicit_cursor(), name)(*args, **kwargs)
+                except Exception:
+                    self._close_cursors()
+                    raise
+            with self._cursor() as c:
+                return getattr(c, name)(*args, **kwargs)
+        finally:
+            if self.lazy:
+                self._release()
+
+    _wrapper.__name__ = name
+    return _wrapper
+
+
+# cursor methods are regular connection methods, so implicit calls skip __getattr__
+for _name, _method in vars(cursor).items():
+    if not _name.startswith('_') and callable(_method) and _name not in vars(connection):
+        setattr(connection, _name, _implicit(_name))
+del _name, _method
+
+
+def _partition_edges(db, table, key, where, count):
+    """Return the lower bounds splitting 'key' of 'table' into at most 'count' ranges."""
+    lo, hi = db.query_one('SELECT min(%s), max(%s) FROM %s' % (key, key, table) + sqlop.where(where), where)
+    if lo is None:
+        return []
+    if isinstance(lo, (int, long)) and isinstance(hi, (int, long)):
+        return sorted(set(lo + (hi - lo + 1) * i // count for i in range(count)))
+    params = dict(where or {}, _fractions=[float(i) / count for i in range(count)])
+    row = db.query_one('SELECT percentile_disc(%%(_fractions)s::float8[]) WITHIN GROUP (ORDER BY %s) FROM %s'
+                       % (key, table) + sqlop.where(where), params)
+    return sorted(set(row[0]))
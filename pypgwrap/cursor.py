@@ -1,15 +1,45 @@
 __author__ = 'Erick Almeida'
 
+import json
 import logging
 import os
+import re
 import time
 import sqlop
+import typeregistry
+import hydrate
 import psycopg2
+from schema import SchemaCache
+
+# statements refused inside a transaction block, which a multi-statement query string is
+_no_transaction = re.compile(r'^\s*(vacuum|create\s+(unique\s+)?index\s+concurrently|drop\s+index\s+concurrently|'
+                             r'reindex\s.*\bconcurrently|(create|drop)\s+(database|tablespace)|alter\s+system|'
+                             r'(create|alter|drop)\s+subscription)\b', re.IGNORECASE | re.DOTALL)
+
+
+class _LoggedCursor(object):
+    """The cursor as given to logf, with the statement timeout prefix removed from the query."""
+
+    def __init__(self, cursor, query):
+        self._cursor = cursor
+        self.query = query
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
 
 
 class cursor(object):
-    def __init__(self, connection, cursor_factory, hstore, log, logf):
+    def __init__(self, connection, cursor_factory, hstore, log, logf, name=None, profiler=None,
+                 slow_query_log=None, timeout=None, schema=None, pool=None):
         self.connection = connection
+        self.pool = pool
+        self.schema = schema
+        self.name = name
+        self.timeout = timeout
+        self.timeout_prefix = None
+        self.profiler = profiler
+        self.slow_query_log = slow_query_log
+        self.fingerprint = None
         if cursor_factory:
             self.cursor_factory = cursor_factory
         else:
@@ -28,6 +58,8 @@ class cursor(object):
             >>> _ = db.select('doctest_t1')
             --- SELECT * FROM doctest_t1 ---
         """
+        if self.timeout_prefix and cursor.query and cursor.query.startswith(self.timeout_prefix):
+            cursor = _LoggedCursor(cursor, cursor.query[len(self.timeout_prefix):])
         msg = self.logf(cursor)
         if msg:
             if isinstance(self.log, logging.Logger):
@@ -55,16 +87,19 @@ class cursor(object):
             >>> db.delete('doctest_t1',where={'name__in':('xxx','yyy','zzz')},returning='name')
             [['xxx']]
         """
-        self.cursor = self.connection.cursor(name=name, cursor_factory=self.cursor_factory)
+        self.cursor = self.connection.cursor(name=name or self.name, cursor_factory=self.cursor_factory)
         if self.hstore:
-            psycopg2.extras.register_hstore(self.cursor)
+            typeregistry.register_hstore(self.cursor)
         return self
 
     def __exit__(self, type, value, traceback):
         self.cursor.close()
 
-    def execute(self, sql, params=None):
+    def execute(self, sql, params=None, timeout=None):
         """
+            The statement is cancelled by the server after 'timeout' seconds
+            (defaults to the connection statement_timeout, 0 disables it).
+
             >>> db = connection()
             >>> db.execute('select name,active FROM doctest_t1')
             10
@@ -74,6 +109,51 @@ class cursor(object):
                 sql = 'EXECUTE %s (%s)' % (sql.name, ','.join(['%s'] * len(params)))
             else:
                 sql = 'EXECUTE %s' % sql.name
+        profiler = self.profiler
+        sampled = profiler is not None and profiler.sample()
+        if sampled or self.slow_query_log is not None:
+            start = time.time()
+            try:
+                return self._execute(sql, params, timeout)
+            finally:
+                elapsed = time.time() - start
+                self.fingerprint = profiler.record(sql, elapsed, self.cursor.rowcount) if sampled else None
+                if self.slow_query_log is not None and elapsed >= self.slow_query_log.threshold \
+                        and self.cursor.query:
+                    query = self.cursor.query
+                    if self.timeout_prefix and query.startswith(self.timeout_prefix):
+                        query = query[len(self.timeout_prefix):]
+                    self.slow_query_log.capture(query, elapsed, self.pool)
+        self.fingerprint = None
+        return self._execute(sql, params, timeout)
+
+    def _execute(self, sql, params, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        self.timeout_prefix = None
+        if timeout is not None:
+            value = max(1, int(timeout * 1000)) if timeout else 0
+            if _no_transaction.match(sql):
+                # sent alone, the session setting is changed around it instead
+                previous = self._set_timeout(value)
+                try:
+                    return self._run(sql, params)
+                finally:
+                    self._set_timeout(previous)
+            # SET LOCAL sent in the same round trip lasts until the end of the (implicit) transaction,
+            # so 0 is sent too, resetting a timeout set by an earlier statement of the transaction
+            prefix = 'SET LOCAL statement_timeout = %d; ' % value
+            if self.cursor.name:
+                c = self.connection.cursor()
+                try:
+                    c.execute(prefix)
+                finally:
+                    c.close()
+            else:
+                self.timeout_prefix = prefix
+                sql = prefix + sql
+        return self._run(sql, params)
+
+    def _run(self, sql, params):
         if self.log and self.logf:
             try:
                 self.cursor.timestamp = time.time()
@@ -85,7 +165,17 @@ class cursor(object):
             self.cursor.execute(sql, params)
             return self.cursor.rowcount
 
-    def query(self, sql, params=None):
+    def _set_timeout(self, value):
+        """Set the session statement_timeout, returning the previous value."""
+        c = self.connection.cursor()
+        try:
+            c.execute("SELECT current_setting('statement_timeout'), set_config('statement_timeout', %s, false)",
+                      (str(value),))
+            return c.fetchone()[0]
+        finally:
+            c.close()
+
+    def query(self, sql, params=None, timeout=None):
         """
             >>> db = connection()
             >>> r = db.query('select name,active FROM doctest_t1 ORDER BY name')
@@ -94,19 +184,25 @@ class cursor(object):
             >>> len(r)
             10
         """
-        self.execute(sql, params)
-        return self.cursor.fetchall()
+        self.execute(sql, params, timeout)
+        rows = self.cursor.fetchall()
+        if self.fingerprint:
+            self.profiler.record_fetch(self.fingerprint, rows)
+        return rows
 
-    def query_one(self, sql, params=None):
+    def query_one(self, sql, params=None, timeout=None):
         """
             >>> db = connection()
             >>> db.query_one('select name,active FROM doctest_t1 WHERE name = %s',('aaaaa',))
             ['aaaaa', True]
         """
-        self.execute(sql, params)
-        return self.cursor.fetchone()
+        self.execute(sql, params, timeout)
+        row = self.cursor.fetchone()
+        if self.fingerprint and row is not None:
+            self.profiler.record_fetch(self.fingerprint, (row,))
+        return row
 
-    def query_dict(self, sql, key, params=None):
+    def query_dict(self, sql, key, params=None, timeout=None):
         """
             >>> db = connection()
             >>> r = db.query_dict('select name,active FROM doctest_t1 ORDER BY name','name')
@@ -116,16 +212,45 @@ class cursor(object):
             ['aaaaa', 'bbbbb', 'ccccc', 'ddddd', 'eeeee', 'fffff', 'ggggg', 'hhhhh', 'iiiii', 'jjjjj']
         """
         _d = {}
-        for row in self.query(sql, params):
+        for row in self.query(sql, params, timeout):
             _d[row[key]] = row
         return _d
 
-    def _build_select(self, table, where, order, columns, limit, offset, update):
+    def query_as(self, cls, sql, params=None, converters=None, timeout=None):
+        """
+            Return the rows as 'cls' instances (see hydrate.hydrator), fetched
+            as plain tuples and converted by a function generated once per
+            class and result columns. 'converters' maps columns to functions
+            applied to their values.
+
+            >>> class Item(object):
+            ...     __slots__ = ('name', 'active')
+            >>> db = connection()
+            >>> items = db.query_as(Item, 'SELECT name, active FROM doctest_t1 ORDER BY name',
+            ...                     converters={'name': str.upper})
+            >>> items[0].name, items[0].active
+            ('AAAAA', True)
+        """
+        if self.cursor_factory is psycopg2.extensions.cursor:
+            c = self
+        else:
+            c = cursor(self.connection, psycopg2.extensions.cursor, self.hstore, self.log, self.logf,
+                       profiler=self.profiler, slow_query_log=self.slow_query_log, timeout=self.timeout,
+                       schema=self.schema, pool=self.pool).__enter__()
+        try:
+            rows = c.query(sql, params, timeout)
+            return hydrate.hydrator(cls, [d[0] for d in c.cursor.description], converters)(rows)
+        finally:
+            if c is not self:
+                c.__exit__(None, None, None)
+
+    def _build_select(self, table, where, order, columns, limit, offset, update, group_by=None, having=None):
         return 'SELECT %s FROM %s' % (sqlop.columns(columns), table) \
-               + sqlop.where(where) + sqlop.order(order) + sqlop.limit(limit) \
-               + sqlop.offset(offset) + sqlop.for_update(update)
+               + sqlop.where(where) + sqlop.group_by(group_by) + sqlop.having(having) \
+               + sqlop.order(order) + sqlop.limit(limit) + sqlop.offset(offset) + sqlop.for_update(update)
 
-    def select(self, table, where=None, order=None, columns=None, limit=None, offset=None, update=False):
+    def select(self, table, where=None, order=None, columns=None, limit=None, offset=None, update=False,
+                   timeout=None, group_by=None, having=None):
         """
             >>> db = connection()
             >>> db.select('doctest_t1') == db.query('SELECT * FROM doctest_t1')
@@ -137,10 +262,15 @@ class cursor(object):
             True
             >>> db.select_one('doctest_t1',columns=('name',),where={'name__in':('bbbbb',)})
             ['bbbbb']
+            >>> db.select('doctest_t1',columns=('active',(sqlop.aggregate('count'),'n')),group_by=('active',),
+            ...           having={sqlop.aggregate('count')+'__gt':0},order=('active',))
+            [[True, 10]]
         """
-        return self.query(self._build_select(table, where, order, columns, limit, offset, update), where)
+        return self.query(self._build_select(table, where, order, columns, limit, offset, update, group_by, having),
+                          sqlop.having_params(having, where), timeout)
 
-    def select_one(self, table, where=None, order=None, columns=None, limit=None, offset=None, update=False):
+    def select_one(self, table, where=None, order=None, columns=None, limit=None, offset=None, update=False,
+                       timeout=None, group_by=None, having=None):
         """
             >>> db = connection()
             >>> db.select_one('doctest_t1',order=('name',),columns=('name',))
@@ -148,24 +278,87 @@ class cursor(object):
             >>> db.select_one('doctest_t1',order=('name',),columns=(('name','abcd'),))
             ['aaaaa']
         """
-        return self.query_one(self._build_select(table, where, order, columns, limit, offset, update), where)
+        return self.query_one(self._build_select(table, where, order, columns, limit, offset, update, group_by, having),
+                              sqlop.having_params(having, where), timeout)
 
-    def select_dict(self, table, key, where=None, order=None, columns=None, limit=None, offset=None, update=False):
+    def select_dict(self, table, key, where=None, order=None, columns=None, limit=None, offset=None, update=False,
+                    timeout=None, group_by=None, having=None):
         """
             >>> db = connection()
             >>> db.select_dict('doctest_t1','name',columns=('name',),order=('name',),limit=2)
             {'aaaaa': ['aaaaa'], 'bbbbb': ['bbbbb']}
         """
-        return self.query_dict(self._build_select(table, where, order, columns, limit, offset, update), key, where)
+        return self.query_dict(self._build_select(table, where, order, columns, limit, offset, update, group_by,
+                                                  having), key, sqlop.having_params(having, where), timeout)
+
+    def count(self, table, where=None, approximate=False, timeout=None):
+        """
+            Number of rows of 'table' matching 'where'. With 'approximate' the
+            table is not scanned: unfiltered counts come from the statistics
+            in pg_class.reltuples and filtered ones from the planner estimate.
+
+            >>> db = connection()
+            >>> db.count('doctest_t1')
+            10
+            >>> db.count('doctest_t1',where={'name__in':('aaaaa','bbbbb')})
+            2
+            >>> db.count('doctest_t1',approximate=True) >= 0
+            True
+        """
+        if not approximate:
+            return self.query_one('SELECT count(*) FROM %s' % table + sqlop.where(where), where, timeout)[0]
+        if not where:
+            estimate = self.query_one('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass',
+                                      (table,), timeout)[0]
+            if estimate >= 0:
+                return estimate
+        # never analyzed (reltuples is -1): the planner estimates from the table size
+        plan = self.query_one('EXPLAIN (FORMAT JSON) SELECT 1 FROM %s' % table + sqlop.where(where), where, timeout)[0]
+        if isinstance(plan, basestring):
+            plan = json.loads(plan)
+        return plan[0]['Plan']['Plan Rows']
+
+    def exists(self, table, where=None, timeout=None):
+        """
+            >>> db = connection()
+            >>> db.exists('doctest_t1',where={'name':'aaaaa'})
+            True
+            >>> db.exists('doctest_t1',where={'name':'xxx'})
+            False
+        """
+        return self.query_one('SELECT EXISTS(SELECT 1 FROM %s' % table + sqlop.where(where) + ' LIMIT 1)',
+                              where, timeout)[0]
+
+    def select_as(self, cls, table, where=None, order=None, columns=None, limit=None, offset=None,
+                  converters=None, timeout=None):
+        """
+            Select rows of 'table' as 'cls' instances (see query_as). The
+            columns default to the class __slots__ or namedtuple fields.
+
+            >>> from collections import namedtuple
+            >>> Item = namedtuple('Item', 'name count')
+            >>> db = connection()
+            >>> db.select_as(Item,'doctest_t1',order=('name',),limit=1)
+            [Item(name='aaaaa', count=0)]
+        """
+        return self.query_as(cls, self._build_select(table, where, order, columns or hydrate.fields(cls), limit,
+                                                     offset, False), where, converters, timeout)
 
     def _build_join(self, tables, where, on, order, columns, limit, offset):
         on = on or [None] * len(tables)
         return 'SELECT %s FROM %s ' % (sqlop.columns(columns), tables[0]) + \
-               " ".join(['JOIN %s ON %s' % (tables[i], sqlop.on((tables[0], tables[i]), on[i - 1]))
+               " ".join(['JOIN %s ON %s' % (tables[i], self._on(tables[0], tables[i], on[i - 1]))
                          for i in range(1, len(tables))]) + \
                sqlop.where(where) + sqlop.order(order) + sqlop.limit(limit) + sqlop.offset(offset)
 
-    def join(self, tables, where=None, on=None, order=None, columns=None, limit=None, offset=None):
+    def _on(self, t1, t2, on):
+        if on is None and self.schema is not None:
+            clause = self.schema.join_on(self.connection, t1, t2)
+            if clause:
+                return clause
+        return sqlop.on((t1, t2), on)
+
+    def join(self, tables, where=None, on=None, order=None, columns=None, limit=None, offset=None, timeout=None):
         """
             >>> db = connection()
             >>> db.join(('doctest_t1','doctest_t2'),columns=('name','value'),
@@ -176,17 +369,18 @@ class cursor(object):
                             == db.join(('doctest_t1','doctest_t2'))
             True
         """
-        return self.query(self._build_join(tables, where, on, order, columns, limit, offset), where)
+        return self.query(self._build_join(tables, where, on, order, columns, limit, offset), where, timeout)
 
-    def join_one(self, tables, where=None, on=None, order=None, columns=None, limit=None, offset=None):
+    def join_one(self, tables, where=None, on=None, order=None, columns=None, limit=None, offset=None, timeout=None):
         """
             >>> db = connection()
             >>> db.join_one(('doctest_t1','doctest_t2'),columns=('name','value'),where={'name':'aaaaa'})
             ['aaaaa', 'aa']
         """
-        return self.query_one(self._build_join(tables, where, on, order, columns, limit, offset), where)
+        return self.query_one(self._build_join(tables, where, on, order, columns, limit, offset), where, timeout)
 
-    def join_dict(self, tables, key, where=None, on=None, order=None, columns=None, limit=None, offset=None):
+    def join_dict(self, tables, key, where=None, on=None, order=None, columns=None, limit=None, offset=None,
+                  timeout=None):
         """
             >>> db = connection()
             >>> db.join_dict(('doctest_t1','doctest_t2'),'name',columns=('name','value'),
@@ -194,7 +388,7 @@ class cursor(object):
             ...               order=('name',),limit=2)
             {'aaaaa': ['aaaaa', 'aa'], 'bbbbb': ['bbbbb', 'bb']}
         """
-        return self.query_dict(self._build_join(tables, where, on, order, columns, limit, offset), key, where)
+        return self.query_dict(self._build_join(tables, where, on, order, columns, limit, offset), key, where, timeout)
 
     def insert(self, table, values, returning=None):
         """
@@ -210,7 +404,8 @@ class cursor(object):
             >>> db.delete('doctest_t1',where={'name__in':('xxx','yyy','zzz')})
             3
         """
-        _values = ['%%(%s)s' % v for v in values.keys()]
+        types = self._types(table, values.keys())
+        _values = ['%%(%s)s' % v + ('::' + types[v] if types else '') for v in values.keys()]
         sql = 'INSERT INTO %s (%s) VALUES (%s)' % (table, ','.join(values.keys()), ','.join(_values))
         if returning:
             sql += ' RETURNING %s' % returning
@@ -218,6 +413,27 @@ class cursor(object):
         else:
             return self.execute(sql, values)
 
+    def insert_many(self, table, rows, columns=None):
+        """
+            Insert a list of rows with a single multi-row INSERT. Rows are
+            dicts (missing values are NULL) or sequences in 'columns' order;
+            columns default to the keys of the first row.
+
+            >>> db = connection()
+            >>> db.insert_many('doctest_t1',[{'name':'xxx','count':1},{'name':'yyy','count':2}])
+            2
+            >>> db.delete('doctest_t1',where={'name__in':('xxx','yyy')})
+            2
+        """
+        if not rows:
+            return 0
+        columns = columns or list(rows[0].keys())
+        types = self._types(table, columns)
+        row_sql = '(' + ','.join(['%s' + ('::' + types[c] if types else '') for c in columns]) + ')'
+        values = ','.join([self.cursor.mogrify(row_sql, [row.get(c) for c in columns] if isinstance(row, dict) else row)
+                           for row in rows])
+        return self.execute('INSERT INTO %s (%s) VALUES ' % (table, ','.join(columns)) + values)
+
     def delete(self, table, where=None, returning=None):
         """
             >>> db = connection()
@@ -253,7 +469,8 @@ class cursor(object):
             >>> db.delete('doctest_t1',{'name':'yyy'})
             1
         """
-        sql = 'UPDATE %s SET %s' % (table, sqlop.update(values))
+        types = self._types(table, [k.partition('__')[0] for k in values.keys()])
+        sql = 'UPDATE %s SET %s' % (table, sqlop.update(values, types))
         sql = self.cursor.mogrify(sql, values)
         if where:
             sql += self.cursor.mogrify(sqlop.where(where), where)
@@ -271,9 +488,37 @@ class cursor(object):
             >>> db.check_table('nonexistent')
             False
         """
+        if self.schema is not None:
+            table = self.schema.table(self.connection, t, 'public')
+            return table is not None and table.kind in ('r', 'p')
         _sql = 'SELECT tablename FROM pg_tables WHERE schemaname=%s and tablename=%s'
         return self.query_one(_sql, ('public', t)) is not None
 
+    def table_info(self, t):
+        """
+            Columns, primary key and constraints of table 't' (None if it does
+            not exist), from the schema cache when configured.
+
+            >>> db = connection()
+            >>> db.table_info('doctest_t1').primary_key
+            ('id',)
+            >>> db.table_info('doctest_t2').foreign_keys[0][2]
+            ('id',)
+        """
+        return (self.schema or SchemaCache(ttl=0)).table(self.connection, t)
+
+    def _types(self, table, columns):
+        """Return the types of the columns of 'table' from the schema cache, checking they exist."""
+        if self.schema is None:
+            return None
+        info = self.schema.table(self.connection, table)
+        if info is None:
+            return None
+        for c in columns:
+            if c not in info.columns:
+                raise psycopg2.ProgrammingError('column "%s" of relation "%s" does not exist' % (c, table))
+        return info.columns
+
     def drop_table(self, t):
         """
             >>> db = connection()
@@ -285,6 +530,8 @@ class cursor(object):
             False
         """
         self.execute('DROP TABLE IF EXISTS %s CASCADE' % t)
+        if self.schema is not None:
+            self.schema.invalidate(t)
 
     def create_table(self, name, schema):
         """
@@ -298,6 +545,8 @@ class cursor(object):
         """
         if not self.check_table(name):
             self.execute('CREATE TABLE %s (%s)' % (name, schema))
+            if self.schema is not None:
+                self.schema.invalidate(name)
 
 
 class PreparedStatement(object):
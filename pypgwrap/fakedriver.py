@@ -0,0 +1,116 @@
+__author__ = 'Erick Almeida'
+
+import psycopg2.extensions as _ext
+
+
+def _quote(value):
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (int, long, float)):
+        return str(value)
+    if isinstance(value, (list, tuple)):
+        return '(' + ','.join(_quote(v) for v in value) + ')'
+    return "'%s'" % str(value).replace("'", "''")
+
+
+class FakeCursor(object):
+    """In-memory cursor returning the driver canned rows for every statement."""
+
+    def __init__(self, connection, name=None):
+        self.connection = connection
+        self.name = name
+        self.rows = connection.driver.rows
+        self.description = connection.driver.description
+        self.query = None
+        self.rowcount = -1
+        self.itersize = 2000
+        self.closed = False
+        self._position = 0
+
+    def mogrify(self, sql, params=None):
+        if params is None:
+            return sql
+        if isinstance(params, dict):
+            return sql % dict((k, _quote(v)) for k, v in params.items())
+        return sql % tuple(_quote(v) for v in params)
+
+    def execute(self, sql, params=None):
+        self.query = sql
+        self.rowcount = len(self.rows)
+        self._position = 0
+        self.connection.driver.executed += 1
+
+    def copy_expert(self, sql, file, size=8192):
+        self.query = sql
+        self.rowcount = len(file.read().splitlines())
+        self.connection.driver.executed += 1
+
+    def fetchone(self):
+        if self._position < len(self.rows):
+            self._position += 1
+            return self.rows[self._position - 1]
+        return None
+
+    def fetchmany(self, size=None):
+        size = size or self.itersize
+        rows = self.rows[self._position:self._position + size]
+        self._position += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self.rows[self._position:]
+        self._position = len(self.rows)
+        return rows
+
+    def close(self):
+        self.closed = True
+
+
+class FakeConnection(object):
+    """In-memory connection, always idle, creating FakeCursor objects."""
+
+    def __init__(self, driver):
+        self.driver = driver
+        self.autocommit = False
+        self.closed = 0
+
+    def cursor(self, name=None, cursor_factory=None, **kwargs):
+        return FakeCursor(self, name)
+
+    def get_transaction_status(self):
+        return _ext.TRANSACTION_STATUS_IDLE
+
+    def cancel(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+class FakeDriver(object):
+    """
+        Driver replacing psycopg2 in the connection pool, so the pypgwrap
+        overhead can be measured without a database. Every statement returns
+        the canned 'rows' (tuples, described by 'columns').
+
+        >>> driver = FakeDriver(rows=[(1, 'abc')], columns=('id', 'name'))
+        >>> pypgwrap.config_pool(driver=driver)
+        >>> pypgwrap.connection().select('t1')
+        [(1, 'abc')]
+    """
+
+    def __init__(self, rows=(), columns=()):
+        self.rows = list(rows)
+        self.description = [(c, None, None, None, None, None, None) for c in columns] or None
+        self.executed = 0
+
+    def connect(self, *args, **kwargs):
+        return FakeConnection(self)
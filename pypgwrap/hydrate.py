@@ -0,0 +1,91 @@
+__author__ = 'Erick Almeida'
+
+import keyword
+import re
+
+_identifier = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+_hydrators = {}  # (cls, columns, converted columns) -> function
+
+
+def fields(cls):
+    """
+        Attribute names of 'cls': the namedtuple _fields, or the __slots__ of
+        the class and its bases (None if instances have a __dict__).
+    """
+    if issubclass(cls, tuple):
+        return tuple(getattr(cls, '_fields', ())) or None
+    names = []
+    for klass in reversed(cls.__mro__[:-1]):
+        if '__slots__' not in klass.__dict__:
+            return None
+        slots = klass.__dict__['__slots__']
+        for name in [slots] if isinstance(slots, basestring) else slots:
+            if name not in ('__dict__', '__weakref__') and name not in names:
+                names.append(name)
+    return tuple(names)
+
+
+def hydrator(cls, columns, converters=None):
+    """
+        Return a function converting a list of row tuples (in 'columns'
+        order) to a list of 'cls' instances, generated once per class,
+        columns and converted columns ('converters' is a dict of column ->
+        function applied to the value, passed to the generated code on each
+        call):
+
+        - __slots__ classes are created with __new__ (bypassing __init__) and
+          the slots assigned directly
+        - namedtuples are created from the values in _fields order
+        - other classes are called with the columns as keyword arguments
+
+        >>> class Item(object):
+        ...     __slots__ = ('id', 'name')
+        >>> items = hydrator(Item, ('id', 'name'), {'name': str.upper})([(1, 'abc')])
+        >>> items[0].name
+        'ABC'
+    """
+    columns = tuple(columns)
+    converters = dict((c, f) for c, f in (converters or {}).items() if c in columns)
+    key = (cls, columns, frozenset(converters))
+    func = _hydrators.get(key)
+    if func is None:
+        func = _hydrators[key] = _compile(cls, columns, converters)
+    return lambda rows: func(rows, converters)
+
+
+def _compile(cls, columns, converters):
+    for c in columns:
+        if not _identifier.match(c) or keyword.iskeyword(c) or c.startswith('_'):
+            raise ValueError('column %r is not a valid attribute name, use an alias' % c)
+    if len(set(columns)) != len(columns):
+        raise ValueError('duplicated columns %s' % (columns,))
+    env = {'_cls': cls, '_new': cls.__new__, '_tuple_new': tuple.__new__}
+    values, setup = {}, []
+    for i, c in enumerate(columns):
+        if c in converters:
+            setup.append('_convert_%d = _converters[%r]' % (i, c))
+            values[c] = '_convert_%d(%s)' % (i, c)
+        else:
+            values[c] = c
+    names = fields(cls)
+    if issubclass(cls, tuple):
+        missing = [f for f in names or () if f not in values]
+        if missing or names is None:
+            raise ValueError('%s needs the columns %s' % (cls.__name__, ', '.join(missing or ('_fields',))))
+        body = ['_append(_tuple_new(_cls, (%s,)))' % ', '.join(values[f] for f in names)]
+    elif names is not None:
+        unknown = [c for c in columns if c not in names]
+        if unknown:
+            raise ValueError('%s has no slots for the columns %s' % (cls.__name__, ', '.join(unknown)))
+        body = ['_obj = _new(_cls)'] + ['_obj.%s = %s' % (c, values[c]) for c in columns] + ['_append(_obj)']
+    else:
+        body = ['_append(_cls(%s))' % ', '.join('%s=%s' % (c, values[c]) for c in columns)]
+    source = 'def _hydrate(rows, _converters):\n' + \
+             ''.join('    %s\n' % line for line in setup) + \
+             '    _result = []\n' \
+             '    _append = _result.append\n' \
+             '    for %s, in rows:\n' % ', '.join(columns) + \
+             ''.join('        %s\n' % line for line in body) + \
+             '    return _result\n'
+    exec source in env
+    return env['_hydrate']
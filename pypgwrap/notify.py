@@ -0,0 +1,182 @@
+__author__ = 'Erick Almeida'
+
+import os
+import Queue
+import select
+import sys
+import threading
+from psycopg2 import OperationalError, InterfaceError
+from connection import get_pool
+
+
+def _quote_ident(name):
+    return '"%s"' % name.replace('"', '""')
+
+
+class NotificationDispatcher(object):
+    """
+        Dispatches LISTEN/NOTIFY notifications to per-channel callbacks or
+        queues. It holds one dedicated connection (outside the pool) and waits
+        on its socket with select(), so idle channels cost no CPU or queries.
+        After a connection failure it reconnects (with exponential backoff)
+        and listens again to every registered channel.
+
+        Notifications arriving within 'batch_window' seconds of each other are
+        delivered together to subscribers registered with batch=True.
+
+        >>> dispatcher = NotificationDispatcher()
+        >>> dispatcher.start()
+        >>> queue = dispatcher.listen('t1_changed')
+        >>> dispatcher.listen('t1_changed', lambda n: cache.pop(n.payload, None))
+        >>> db.execute("NOTIFY t1_changed, '42'")
+        >>> queue.get(timeout=1).payload
+        '42'
+        >>> dispatcher.stop()
+    """
+
+    def __init__(self, pool=None, batch_window=0.0, poll_timeout=5.0, reconnect_delay=1.0,
+                 max_reconnect_delay=30.0, on_error=None):
+        self.pool = pool or get_pool()
+        self.batch_window = batch_window
+        self.poll_timeout = poll_timeout
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.on_error = on_error
+        self._lock = threading.Lock()
+        self._channels = {}  # channel -> [(target, batch)]
+        self._commands = Queue.Queue()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._conn = None
+
+    def listen(self, channel, target=None, batch=False):
+        """
+            Subscribe 'target' (a callable, or an object with a put method such
+            as Queue.Queue) to 'channel'. A new Queue is created if 'target' is
+            None. With 'batch' the target receives lists of notifications.
+        """
+        if target is None:
+            target = Queue.Queue()
+        with self._lock:
+            subscribers = self._channels.setdefault(channel, [])
+            subscribers.append((target, batch))
+            if len(subscribers) == 1:
+                self._command('LISTEN', channel)
+        return target
+
+    def unlisten(self, channel, target=None):
+        """Remove 'target' (or every subscriber if None) from 'channel'."""
+        with self._lock:
+            subscribers = [s for s in self._channels.get(channel, []) if target is not None and s[0] is not target]
+            if subscribers:
+                self._channels[channel] = subscribers
+            elif self._channels.pop(channel, None) is not None:
+                self._command('UNLISTEN', channel)
+
+    def start(self):
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        os.write(self._wakeup_w, 'x')
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._close()
+
+    def _command(self, action, channel):
+        self._commands.put((action, channel))
+        os.write(self._wakeup_w, 'x')
+
+    def _connect(self):
+        conn = self.pool.driver.connect(*self.pool._args, **self.pool._kwargs)
+        conn.autocommit = True
+        # every registered channel is listened again, pending commands are redundant
+        while True:
+            try:
+                self._commands.get_nowait()
+            except Queue.Empty:
+                break
+        with self._lock:
+            channels = list(self._channels)
+        for channel in channels:
+            self._execute(conn, 'LISTEN', channel)
+        return conn
+
+    def _close(self):
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def _execute(self, conn, action, channel):
+        cur = conn.cursor()
+        try:
+            cur.execute('%s %s' % (action, _quote_ident(channel)))
+        finally:
+            cur.close()
+
+    def _run(self):
+        delay = self.reconnect_delay
+        while not self._stopped.is_set():
+            try:
+                if self._conn is None:
+                    self._conn = self._connect()
+                    delay = self.reconnect_delay
+                self._step()
+            except (OperationalError, InterfaceError, select.error):
+                self._report()
+                self._close()
+                self._stopped.wait(delay)
+                delay = min(delay * 2, self.max_reconnect_delay)
+
+    def _step(self):
+        conn = self._conn
+        ready = select.select([conn, self._wakeup_r], [], [], self.poll_timeout)[0]
+        if self._wakeup_r in ready:
+            os.read(self._wakeup_r, 1024)
+        while True:
+            try:
+                action, channel = self._commands.get_nowait()
+            except Queue.Empty:
+                break
+            self._execute(conn, action, channel)
+        if conn in ready:
+            conn.poll()
+            if conn.notifies and self.batch_window:
+                # coalesce a burst into a single delivery
+                select.select([conn], [], [], self.batch_window)
+                conn.poll()
+            notifies = conn.notifies[:]
+            del conn.notifies[:]
+            if notifies:
+                self._dispatch(notifies)
+
+    def _dispatch(self, notifies):
+        by_channel = {}
+        for n in notifies:
+            by_channel.setdefault(n.channel, []).append(n)
+        for channel, items in by_channel.items():
+            with self._lock:
+                subscribers = list(self._channels.get(channel, ()))
+            for target, batch in subscribers:
+                deliver = getattr(target, 'put', target)
+                try:
+                    if batch:
+                        deliver(items)
+                    else:
+                        for n in items:
+                            deliver(n)
+                except Exception:
+                    self._report()
+
+    def _report(self):
+        if self.on_error:
+            self.on_error(sys.exc_info())
@@ -3,12 +3,19 @@ import os
 
 __author__ = 'Erick Almeida'
 
+import collections
 import datetime
+import select
+import time
 import psycopg2
 import psycopg2.extensions as _ext
 from psycopg2.pool import PoolError
 
 
+class PoolOverloadError(PoolError):
+    """Raised when the wait queue of a priority class is full or its wait timed out."""
+
+
 class AbstractConnectionPool(object):
     """Generic key-based pooling code."""
 
@@ -19,6 +26,36 @@ class AbstractConnectionPool(object):
         self._tused = {}
         self._keys = 0
         self.closed = False
+        self.profiler = None
+        self.driver = psycopg2
+        self.lazy = False
+        self.statement_timeout = None
+        self.cached_cursor = False
+        self.priorities = {}
+        self._class_used = {}  # priority -> connections in use
+        self._cused = {}  # id(conn) -> priority
+        self._waiting = {}  # priority -> waiting threads
+        self.slow_query_log = None
+        self.autocommit = True
+        self.session_settings = {}
+        self.on_connect = None
+        self.type_registry = None
+        self._session_version = 0
+        self._sinit = {}  # id(conn) -> session version applied
+        self.validate_after = None
+        self.validation = 'ping'
+        self.validation_stats = {'checks': 0, 'failures': 0, 'skipped': 0, 'time': 0.0}
+        self._tidle = {}  # id(conn) -> time it went back to the pool
+        self.schema = None
+        self.adaptive = None
+        self.ceiling = None
+        self.adaptive_decisions = collections.deque(maxlen=50)
+        self._window = None
+        self._calm = 0  # consecutive intervals with low usage
+        self._last_decision = None
+        self.budget = None
+        self._slots = {}  # id(conn) -> budget slot
+        self._connecting = 0  # connections being opened or validated, see _connect() and _checkout()
 
     def configure(self, expiration, maxconn, *args, **kwargs):
         """Initialize the connection pool.
@@ -32,31 +69,267 @@ class AbstractConnectionPool(object):
 
         self._args = args
         self._kwargs = kwargs
+        self.autocommit = ast.literal_eval(os.getenv('PYPGWRAP_AUTOCOMMIT', "True"))
+
+    def configure_session(self, session_settings=None, on_connect=None, type_registry=None):
+        """Set the session settings (name -> value), 'on_connect' callback and type registry.
+
+        They are applied once on each new physical connection; connections
+        initialized before a reconfiguration are updated on checkout. Only
+        the configuration version is compared: a SET or RESET run by the
+        caller on a connection is not detected and stays in the pool.
+        """
+        self.session_settings = session_settings or {}
+        self.on_connect = on_connect
+        self.type_registry = type_registry
+        self._session_version += 1
+
+    def _init_session(self, conn):
+        if self.type_registry:
+            self.type_registry.register(conn)
+        if self.session_settings:
+            items = sorted(self.session_settings.items())
+            cur = conn.cursor()
+            try:
+                cur.execute('SELECT ' + ', '.join(['set_config(%s, %s, false)'] * len(items)),
+                            [v for name, value in items for v in (name, str(value))])
+            finally:
+                cur.close()
+        if self.on_connect:
+            self.on_connect(conn)
+        if not conn.autocommit:
+            conn.commit()
+        self._sinit[id(conn)] = self._session_version
+
+    def configure_validation(self, validate_after=None, validation='ping'):
+        """Validate pooled connections idle for more than 'validate_after' seconds on checkout.
+
+        'ping' runs SELECT 1, 'socket' only pings when the socket has pending
+        data (usually the server closing the connection). None disables it.
+        """
+        if validation not in ('ping', 'socket'):
+            raise ValueError('unknown validation %s' % validation)
+        self.validate_after = validate_after
+        self.validation = validation
+
+    def _validate(self, conn):
+        """Check if an idle pooled connection is still usable, updating validation_stats."""
+        stats = self.validation_stats
+        if conn.closed:
+            stats['failures'] += 1
+            return False
+        if self.validate_after is None or time.time() - self._tidle.get(id(conn), 0) < self.validate_after:
+            stats['skipped'] += 1
+            return True
+        start = time.time()
+        valid = self._unlocked(lambda: self._ping(conn))
+        stats['checks'] += 1
+        stats['time'] += time.time() - start
+        if not valid:
+            stats['failures'] += 1
+        return valid
+
+    def _ping(self, conn):
+        try:
+            if self.validation == 'ping' or select.select([conn], [], [], 0)[0]:
+                cur = conn.cursor()
+                try:
+                    cur.execute('SELECT 1')
+                    cur.fetchone()
+                finally:
+                    cur.close()
+                if not conn.autocommit:
+                    conn.rollback()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError, select.error):
+            return False
+        return True
 
     def _connect(self, key=None):
-        """Create a new connection and assign it to 'key' if not None."""
-        conn = psycopg2.connect(*self._args, **self._kwargs)
-        conn.autocommit = ast.literal_eval(os.getenv('PYPGWRAP_AUTOCOMMIT', "True"))
-        if key is not None:
+        """Create a new connection and assign it to 'key' if not None.
+
+        Waiting for a budget slot and opening the connection run through
+        _unlocked(), so a threaded pool does not hold its lock meanwhile;
+        returns None if 'key' was checked out by another thread in between.
+        """
+        slot = None
+        self._connecting += 1
+        try:
+            if self.budget is not None:
+                slot = self.budget.try_acquire()
+                if slot is None:
+                    slot = self._unlocked(self.budget.acquire)
+            conn = self._unlocked(self._open)
+        except Exception:
+            if slot is not None:
+                self.budget.release(slot)
+            raise
+        finally:
+            self._connecting -= 1
+        if slot is not None:
+            self._slots[id(conn)] = slot
+        if self.closed:
+            self._disconnect(conn)
+            raise PoolError("connection pool is closed")
+        self._tused[id(conn)] = datetime.datetime.now()
+        if key is not None and key not in self._used:
             self._used[key] = conn
             self._rused[id(conn)] = key
-            self._tused[id(conn)] = datetime.datetime.now()
-        else:
-            self._pool.append(conn)
+            return conn
+        self._pool.append(conn)
+        self._tidle[id(conn)] = time.time()
+        return None if key is not None else conn
+
+    def _open(self):
+        conn = self.driver.connect(*self._args, **self._kwargs)
+        try:
+            conn.autocommit = True
+            self._init_session(conn)
+            conn.autocommit = self.autocommit
+        except Exception:
+            conn.close()
+            raise
         return conn
 
+    def _unlocked(self, func):
+        """Call 'func' without the pool lock (there is none in this pool)."""
+        return func()
+
     def _disconnect(self, conn, remove_from_pool=False):
         if remove_from_pool and conn in self._pool:
             self._pool.remove(conn)
         conn.close()
-        del self._tused[id(conn)]
+        self._tused.pop(id(conn), None)
+        self._sinit.pop(id(conn), None)
+        self._tidle.pop(id(conn), None)
+        slot = self._slots.pop(id(conn), None)
+        if slot is not None:
+            self.budget.release(slot)
+
+    def configure_budget(self, budget=None):
+        """Take a slot of the host-wide ConnectionBudget 'budget' for each physical connection."""
+        self.budget = budget
+        if budget is not None:
+            budget.register(self)
+
+    def _release_idle(self, keep=0):
+        """Close idle pooled connections beyond 'keep', least recently used first. Returns how many."""
+        closed = 0
+        while len(self._pool) > keep:
+            self._disconnect(self._pool.pop(0))
+            closed += 1
+        return closed
+
+    def configure_priorities(self, priorities):
+        """Set the priority classes, as a dict of name -> {'reserved', 'queue', 'timeout'}."""
+        priorities = priorities or {}
+        if sum(lane.get('reserved', 0) for lane in priorities.values()) > self.maxconn:
+            raise ValueError('reserved connections exceed maxconn')
+        self.priorities = priorities
+
+    def _admit(self, priority, limit=None):
+        """Check if a connection can be checked out for 'priority' without taking other reserves."""
+        limit = limit or self.maxconn
+        if len(self._used) + self._connecting >= limit:
+            return False
+        if not self.priorities:
+            return True
+        if self._class_used.get(priority, 0) < self.priorities.get(priority, {}).get('reserved', 0):
+            return True
+        reserved = sum(lane.get('reserved', 0) for lane in self.priorities.values())
+        shared = 0
+        for p, used in self._class_used.items():
+            shared += max(0, used - self.priorities.get(p, {}).get('reserved', 0))
+        return shared < limit - reserved
+
+    def configure_adaptive(self, adaptive=None):
+        """Size the pool by demand, between 'min_pool' and 'maxconn' (the hard ceiling).
+
+        The current size (self.maxconn) is reviewed every 'interval' seconds.
+        It grows by 'step' (fraction of the size) when checkouts had to go
+        over it, which they do after waiting 'target_wait' seconds for a
+        connection, or waited longer than that on average. It shrinks by
+        'step' after 'shrink_after' consecutive intervals with the peak usage
+        below 'shrink_ratio' of the size, closing the idle connections above
+        it. Decisions are kept in 'adaptive_decisions', see adaptive_state().
+        """
+        if self.ceiling is not None:
+            self.maxconn = self.ceiling
+        self.adaptive = None
+        self.ceiling = None
+        if not adaptive:
+            return
+        options = {'min_pool': 1, 'target_wait': 0.05, 'interval': 10.0, 'step': 0.25,
+                   'shrink_after': 3, 'shrink_ratio': 0.5}
+        unknown = set(adaptive) - set(options)
+        if unknown:
+            raise ValueError('unknown adaptive options %s' % ', '.join(sorted(unknown)))
+        options.update(adaptive)
+        reserved = sum(lane.get('reserved', 0) for lane in self.priorities.values())
+        options['min_pool'] = min(max(options['min_pool'], reserved, 1), self.maxconn)
+        self.adaptive = options
+        self.ceiling = self.maxconn
+        self.maxconn = options['min_pool']
+        self._calm = 0
+        self._new_window(time.time())
+
+    def _new_window(self, now):
+        self._window = {'start': now, 'checkouts': 0, 'waits': 0, 'wait_time': 0.0, 'overflows': 0,
+                        'rejected': 0, 'peak': len(self._used)}
+
+    def _record_wait(self, seconds):
+        if self._window is not None:
+            self._window['waits'] += 1
+            self._window['wait_time'] += seconds
+
+    def _adapt(self, now):
+        """Review the pool size with the usage of the interval just finished."""
+        options, window = self.adaptive, self._window
+        size = self.maxconn
+        step = max(1, int(size * options['step']))
+        avg_wait = window['wait_time'] / window['waits'] if window['waits'] else 0.0
+        if window['overflows'] or window['rejected'] or avg_wait > options['target_wait']:
+            self._calm = 0
+            new_size = min(self.ceiling, max(size, window['peak']) + step)
+            reason = 'grow: %d over size, %d rejected, %.3fs average wait' % (
+                window['overflows'], window['rejected'], avg_wait)
+        elif window['peak'] < size * options['shrink_ratio']:
+            self._calm += 1
+            new_size = size
+            reason = 'hold: low usage %d/%d' % (self._calm, options['shrink_after'])
+            if self._calm >= options['shrink_after']:
+                self._calm = 0
+                new_size = max(options['min_pool'], window['peak'] + 1, size - step)
+                reason = 'shrink: peak %d below %.0f%% of %d' % (window['peak'], options['shrink_ratio'] * 100, size)
+        else:
+            self._calm = 0
+            new_size = size
+            reason = 'hold'
+        decision = dict(window, time=now, size=size, new_size=new_size, reason=reason, avg_wait=avg_wait)
+        self._last_decision = decision
+        if new_size != size:
+            self.adaptive_decisions.append(decision)
+            self.maxconn = new_size
+            # idle connections above the new size, least recently used first
+            while self._pool and len(self._pool) + len(self._used) > new_size:
+                self._disconnect(self._pool.pop(0))
+        self._new_window(now)
+
+    def adaptive_state(self):
+        """Current adaptive sizing state: size, ceiling, usage, last review and size changes."""
+        return {'size': self.maxconn,
+                'ceiling': self.ceiling,
+                'in_use': len(self._used),
+                'idle': len(self._pool),
+                'window': dict(self._window) if self._window else None,
+                'last_review': self._last_decision,
+                'decisions': list(self.adaptive_decisions)}
 
     def _getkey(self):
         """Return a new unique key."""
         self._keys += 1
         return self._keys
 
-    def _getconn(self, key=None, exactly=False):
+    def _getconn(self, key=None, exactly=False, priority=None):
         """Get a free connection and assign it to 'key' if not None."""
         internal_key = False
         if self.closed:
@@ -69,15 +342,63 @@ class AbstractConnectionPool(object):
         if not internal_key and exactly:
             return None
 
-        if self._pool:
-            self._used[key] = conn = self._pool.pop()
+        if self.adaptive is not None:
+            now = time.time()
+            if now - self._window['start'] >= self.adaptive['interval']:
+                self._adapt(now)
+        if not self._admit(priority):
+            if self.adaptive is None or not self._admit(priority, self.ceiling):
+                if self._window is not None:
+                    self._window['rejected'] += 1
+                raise PoolError("connection pool exausted")
+            self._window['overflows'] += 1
+        conn = None
+        while self._pool and conn is None:
+            conn = self._checkout()
+        if conn is not None:
+            if key in self._used:
+                # checked out by another thread while this one was validated
+                self._pool.append(conn)
+                return self._used[key]
+            self._used[key] = conn
             self._rused[id(conn)] = key
             self._tused[id(conn)] = datetime.datetime.now()
-            return conn
         else:
-            if len(self._used) == self.maxconn:
-                raise PoolError("connection pool exausted")
-            return self._connect(key)
+            conn = self._connect(key)
+            if conn is None:
+                return self._used[key]
+        self._cused[id(conn)] = priority
+        self._class_used[priority] = self._class_used.get(priority, 0) + 1
+        if self._window is not None:
+            self._window['checkouts'] += 1
+            self._window['peak'] = max(self._window['peak'], len(self._used))
+        return conn
+
+    def _checkout(self):
+        """Pop a pooled connection, validate it and update its session.
+
+        Both run through _unlocked(), with the connection counted as being
+        opened; returns None if it was dead and has been closed.
+        """
+        conn = self._pool.pop()
+        self._connecting += 1
+        try:
+            if not self._validate(conn):
+                # dead connections are replaced transparently
+                self._disconnect(conn)
+                return None
+            if self._sinit.get(id(conn)) != self._session_version:
+                try:
+                    self._unlocked(lambda: self._init_session(conn))
+                except Exception:
+                    self._disconnect(conn)
+                    raise
+        finally:
+            self._connecting -= 1
+        if self.closed:
+            self._disconnect(conn)
+            raise PoolError("connection pool is closed")
+        return conn
 
     def clear_expired_connections(self):
         now = datetime.datetime.now()
@@ -106,15 +427,22 @@ class AbstractConnectionPool(object):
                 status = conn.get_transaction_status()
                 if status == _ext.TRANSACTION_STATUS_UNKNOWN:
                     # server connection lost
-                    self._disconnect(conn.close)
+                    self._disconnect(conn)
                 elif status != _ext.TRANSACTION_STATUS_IDLE:
                     # connection in error or in transaction
-                    conn.rollback()
-                    self._pool.append(conn)
+                    try:
+                        conn.rollback()
+                        self._pool.append(conn)
+                        self._tidle[id(conn)] = time.time()
+                    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                        self._disconnect(conn)
                 else:
                     # regular idle connection
                     self._pool.append(conn)
-                    # If the connection is closed, we just discard it.
+                    self._tidle[id(conn)] = time.time()
+            else:
+                # If the connection is closed, we just discard it.
+                self._disconnect(conn)
         else:
             self._disconnect(conn)
 
@@ -125,6 +453,8 @@ class AbstractConnectionPool(object):
         if not self.closed or key in self._used:
             del self._used[key]
             del self._rused[id(conn)]
+            if id(conn) in self._cused:
+                self._class_used[self._cused.pop(id(conn))] -= 1
 
     def _closeall(self):
         """Close all connections.
@@ -140,6 +470,10 @@ class AbstractConnectionPool(object):
                 conn.close()
             except:
                 pass
+        if self.budget is not None:
+            for slot in self._slots.values():
+                self.budget.release(slot)
+            self._slots.clear()
         self.closed = True
 
     def __del__(self):
@@ -152,6 +486,7 @@ class SimpleConnectionPool(AbstractConnectionPool):
     getconn = AbstractConnectionPool._getconn
     putconn = AbstractConnectionPool._putconn
     closeall = AbstractConnectionPool._closeall
+    release_idle = AbstractConnectionPool._release_idle
 
 
 class ThreadedConnectionPool(AbstractConnectionPool):
@@ -162,20 +497,80 @@ class ThreadedConnectionPool(AbstractConnectionPool):
         import threading
         AbstractConnectionPool.__init__(self)
         self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
 
-    def getconn(self, key=None, exactly=False):
-        """Get a free connection and assign it to 'key' if not None."""
+    def getconn(self, key=None, exactly=False, priority=None):
+        """Get a free connection and assign it to 'key' if not None.
+
+        When the pool is saturated, a configured priority class waits up to
+        its 'timeout' for a connection, with at most 'queue' waiters.
+        """
         self._lock.acquire()
         try:
-            return self._getconn(key, exactly)
+            lane = self.priorities.get(priority)
+            if (lane or self.adaptive) and not (key is not None and (key in self._used or exactly)) \
+                    and not self._admit(priority):
+                start = time.time()
+                try:
+                    if lane:
+                        self._wait(priority, lane)
+                    else:
+                        # with adaptive sizing, wait a bit before going over the current size
+                        self._wait_admission(priority, self.adaptive['target_wait'])
+                finally:
+                    self._record_wait(time.time() - start)
+            return self._getconn(key, exactly, priority)
         finally:
             self._lock.release()
 
+    def _wait(self, priority, lane):
+        waiting = self._waiting.get(priority, 0)
+        if waiting >= lane.get('queue', 0):
+            raise PoolOverloadError("connection pool overloaded [{priority}]".format(priority=priority))
+        self._waiting[priority] = waiting + 1
+        try:
+            if not self._wait_admission(priority, lane.get('timeout', 1.0)):
+                raise PoolOverloadError("timeout waiting connection [{priority}]".format(priority=priority))
+        finally:
+            self._waiting[priority] -= 1
+
+    def _wait_admission(self, priority, timeout):
+        """Wait up to 'timeout' seconds for a connection; with adaptive sizing, after
+        'target_wait' seconds one over the current size (up to the ceiling) is also taken."""
+        now = time.time()
+        deadline = now + timeout
+        overflow_at = now + self.adaptive['target_wait'] if self.adaptive else None
+        while not self._admit(priority):
+            if overflow_at is not None and now >= overflow_at and self._admit(priority, self.ceiling):
+                return True
+            if now >= deadline:
+                return False
+            self._available.wait((overflow_at if overflow_at is not None and now < overflow_at else deadline) - now)
+            now = time.time()
+        return True
+
+    def _unlocked(self, func):
+        """Call 'func' releasing the lock meanwhile (waiting for a budget slot, connecting, validating)."""
+        self._lock.release()
+        try:
+            return func()
+        finally:
+            self._lock.acquire()
+
     def putconn(self, conn=None, key=None, close=False):
         """Put away an unused connection."""
         self._lock.acquire()
         try:
             self._putconn(conn, key, close)
+            self._available.notify_all()
+        finally:
+            self._lock.release()
+
+    def release_idle(self, keep=0):
+        """Close idle pooled connections beyond 'keep'."""
+        self._lock.acquire()
+        try:
+            return self._release_idle(keep)
         finally:
             self._lock.release()
 
@@ -0,0 +1,146 @@
+__author__ = 'Erick Almeida'
+
+import random
+import re
+import threading
+
+_fingerprint_rules = [(re.compile(r"'(?:[^']|'')*'"), '?'),
+                      (re.compile(r'%\([^)]*\)s|%s|\$\d+'), '?'),
+                      (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+                      (re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)'), '(?)'),
+                      (re.compile(r'\s+'), ' '),
+]
+
+_fingerprint_cache = {}
+_fingerprint_cache_size = 10000
+
+
+def fingerprint(sql):
+    """
+        Normalize a statement so that executions differing only by literal
+        values share the same fingerprint.
+
+        >>> fingerprint("SELECT * FROM t1 WHERE id = 10 AND name IN ('a','b')")
+        'SELECT * FROM t1 WHERE id = ? AND name IN (?)'
+        >>> fingerprint('UPDATE t1 SET name = %(name)s WHERE id = %s')
+        'UPDATE t1 SET name = ? WHERE id = ?'
+    """
+    fp = _fingerprint_cache.get(sql)
+    if fp is None:
+        fp = sql
+        for pattern, replace in _fingerprint_rules:
+            fp = pattern.sub(replace, fp)
+        fp = fp.strip()
+        if len(_fingerprint_cache) >= _fingerprint_cache_size:
+            _fingerprint_cache.clear()
+        _fingerprint_cache[sql] = fp
+    return fp
+
+
+def _percentile(samples, p):
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(round(p * (len(samples) - 1))))]
+
+
+def _payload_size(rows):
+    size = 0
+    for row in rows:
+        for value in row:
+            if isinstance(value, (str, unicode, buffer, bytearray)):
+                size += len(value)
+            elif value is not None:
+                size += 8
+    return size
+
+
+class _Stat(object):
+    __slots__ = ('lock', 'calls', 'total_time', 'rows', 'bytes', 'samples', 'max_samples')
+
+    def __init__(self, max_samples):
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.total_time = 0.0
+        self.rows = 0
+        self.bytes = 0
+        self.samples = []
+        self.max_samples = max_samples
+
+    def add(self, elapsed, rows):
+        with self.lock:
+            self.calls += 1
+            self.total_time += elapsed
+            if rows > 0:
+                self.rows += rows
+            # reservoir sampling keeps the percentile estimation bounded in memory
+            if len(self.samples) < self.max_samples:
+                self.samples.append(elapsed)
+            else:
+                i = random.randint(0, self.calls - 1)
+                if i < self.max_samples:
+                    self.samples[i] = elapsed
+
+
+class Profiler(object):
+    """
+        Aggregates statement statistics by fingerprint.
+
+        sample_rate : fraction of statements measured (1.0 measures all)
+        max_samples : latency samples kept per fingerprint for percentiles
+
+        >>> profiler = Profiler(sample_rate=0.1)
+        >>> pypgwrap.config_pool(url='postgres://localhost/', profiler=profiler)
+        >>> profiler.top(1)
+        [{'fingerprint': 'SELECT * FROM t1 WHERE id = ?', 'calls': 10, ...}]
+    """
+
+    def __init__(self, sample_rate=1.0, max_samples=1000):
+        self.sample_rate = sample_rate
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def sample(self):
+        return self.sample_rate >= 1.0 or random.random() < self.sample_rate
+
+    def _stat(self, fp):
+        stat = self._stats.get(fp)
+        if stat is None:
+            with self._lock:
+                stat = self._stats.setdefault(fp, _Stat(self.max_samples))
+        return stat
+
+    def record(self, sql, elapsed, rows):
+        """Record one execution and return its fingerprint."""
+        fp = fingerprint(sql)
+        self._stat(fp).add(elapsed, rows)
+        return fp
+
+    def record_fetch(self, fp, rows):
+        """Account the payload of rows fetched for a recorded execution."""
+        size = _payload_size(rows)
+        stat = self._stat(fp)
+        with stat.lock:
+            stat.bytes += size
+
+    def stats(self):
+        result = []
+        for fp, stat in self._stats.items():
+            with stat.lock:
+                samples = sorted(stat.samples)
+                result.append({'fingerprint': fp,
+                               'calls': stat.calls,
+                               'total_time': stat.total_time,
+                               'p50': _percentile(samples, 0.50),
+                               'p99': _percentile(samples, 0.99),
+                               'rows': stat.rows,
+                               'bytes': stat.bytes})
+        return result
+
+    def top(self, n=10, key='total_time'):
+        """Return the 'n' fingerprints with the highest 'key' statistic."""
+        return sorted(self.stats(), key=lambda s: s[key], reverse=True)[:n]
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
@@ -0,0 +1,129 @@
+__author__ = 'Erick Almeida'
+
+import threading
+import time
+from collections import OrderedDict
+
+_RELATION = '''SELECT c.oid, c.relkind FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+               WHERE n.nspname = %s AND c.relname = %s'''
+
+_COLUMNS = '''SELECT a.attname, format_type(a.atttypid, a.atttypmod) FROM pg_attribute a
+              WHERE a.attrelid = %s AND a.attnum > 0 AND NOT a.attisdropped ORDER BY a.attnum'''
+
+_CONSTRAINTS = '''SELECT c.contype, c.confrelid,
+                         ARRAY(SELECT a.attname FROM unnest(c.conkey) WITH ORDINALITY k(n, i)
+                               JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = k.n ORDER BY k.i),
+                         ARRAY(SELECT a.attname FROM unnest(c.confkey) WITH ORDINALITY k(n, i)
+                               JOIN pg_attribute a ON a.attrelid = c.confrelid AND a.attnum = k.n ORDER BY k.i)
+                  FROM pg_constraint c WHERE c.conrelid = %s AND c.contype IN ('p', 'u', 'f')
+                  ORDER BY c.conname'''
+
+
+class Table(object):
+    """
+        Metadata of a table: 'columns' (ordered dict of name -> type),
+        'primary_key' (tuple of column names), 'unique' (list of column
+        tuples) and 'foreign_keys' (list of (columns, referenced table oid,
+        referenced columns)).
+    """
+
+    def __init__(self, name, oid, kind, columns, primary_key, unique, foreign_keys):
+        self.name = name
+        self.oid = oid
+        self.kind = kind
+        self.columns = columns
+        self.primary_key = primary_key
+        self.unique = unique
+        self.foreign_keys = foreign_keys
+        self.loaded = time.time()
+
+    def __repr__(self):
+        return '<Table %s %s>' % (self.name, ', '.join('%s %s' % c for c in self.columns.items()))
+
+
+class SchemaCache(object):
+    """
+        Table metadata (columns and types, primary key, unique and foreign
+        key constraints) loaded from the catalogs on first use and kept for
+        'ttl' seconds (forever if None). Set in config_pool, it is used by
+        check_table, by insert/insert_many/update to validate the columns and
+        type the parameters, and by join to find the default 'on' columns
+        from the foreign keys. DDL run outside create_table/drop_table should
+        be followed by invalidate().
+
+        >>> schema = SchemaCache(ttl=600)
+        >>> pypgwrap.config_pool(url='postgres://localhost/', schema=schema)
+        >>> db.table_info('t1').primary_key
+        ('id',)
+        >>> schema.invalidate('t1')
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._tables = {}  # (dsn, table, namespace) -> Table
+
+    def table(self, conn, name, namespace=None):
+        """
+            Return the Table 'name' of the database of the psycopg2 connection
+            'conn' (None if not found), resolved through the search_path or,
+            with 'namespace', the relation of that exact name in that schema.
+        """
+        key = (getattr(conn, 'dsn', None), name, namespace)
+        table = self._tables.get(key)
+        if table is None or (self.ttl is not None and time.time() - table.loaded > self.ttl):
+            table = self._load(conn, name, namespace)
+            with self._lock:
+                if table is None:
+                    self._tables.pop(key, None)
+                else:
+                    self._tables[key] = table
+        return table
+
+    def invalidate(self, name=None):
+        """Forget the metadata of table 'name' (every table if None)."""
+        with self._lock:
+            if name is None:
+                self._tables.clear()
+            else:
+                for key in [k for k in self._tables if k[1] == name]:
+                    del self._tables[key]
+
+    def join_on(self, conn, t1, t2):
+        """Return the join condition of a foreign key between tables t1 and t2, or None."""
+        info1, info2 = self.table(conn, t1), self.table(conn, t2)
+        if info1 is None or info2 is None:
+            return None
+        for (child, child_name), (parent, parent_name) in (((info2, t2), (info1, t1)), ((info1, t1), (info2, t2))):
+            for columns, ref_oid, ref_columns in child.foreign_keys:
+                if ref_oid == parent.oid:
+                    return ' AND '.join(['%s.%s = %s.%s' % (parent_name, p, child_name, c)
+                                         for p, c in zip(ref_columns, columns)])
+        return None
+
+    def _load(self, conn, name, namespace=None):
+        # missing tables are not cached, they may be created at any time
+        cur = conn.cursor()
+        try:
+            if namespace is None:
+                cur.execute('SELECT oid, relkind FROM pg_class WHERE oid = to_regclass(%s)', (name,))
+            else:
+                cur.execute(_RELATION, (namespace, name))
+            row = cur.fetchone()
+            if row is None:
+                return None
+            oid, kind = row
+            cur.execute(_COLUMNS, (oid,))
+            columns = OrderedDict(cur.fetchall())
+            cur.execute(_CONSTRAINTS, (oid,))
+            primary_key, unique, foreign_keys = (), [], []
+            for contype, ref_oid, keys, ref_keys in cur.fetchall():
+                if contype == 'p':
+                    primary_key = tuple(keys)
+                elif contype == 'u':
+                    unique.append(tuple(keys))
+                else:
+                    foreign_keys.append((tuple(keys), ref_oid, tuple(ref_keys)))
+            return Table(name, oid, kind, columns, primary_key, unique, foreign_keys)
+        finally:
+            cur.close()
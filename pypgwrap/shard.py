@@ -0,0 +1,77 @@
+__author__ = 'Erick Almeida'
+
+import sys
+import threading
+from connection import connection, get_shards
+
+
+def _sort(rows, order):
+    """Sort rows by the 'order' spec (column or column__desc), as sqlop.order does in SQL."""
+    rows = list(rows)
+    # stable sorts from the last to the first column give the multi-column order
+    for f in reversed(order or ()):
+        field, _, direction = f.partition('__')
+        field = field.split('.')[-1]
+        rows.sort(key=lambda row: row[field], reverse=direction == 'desc')
+    return rows
+
+
+def scatter(method, *args, **kwargs):
+    """
+        Run connection method 'method' on every shard concurrently (each on
+        a connection of its shard pool) and return a dict of shard name ->
+        result. Connection options are taken from 'connection_options'.
+
+        >>> scatter('query_one', 'SELECT count(*) FROM t1')
+        {'s0': [10], 's1': [12]}
+    """
+    options = kwargs.pop('connection_options', {})
+    results = {}
+    errors = []
+
+    def _run(shard):
+        try:
+            with connection(shard=shard, **options) as db:
+                results[shard] = getattr(db, method)(*args, **kwargs)
+        except Exception:
+            errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=_run, args=(shard,)) for shard in get_shards()]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        exc_info = errors[0]
+        raise exc_info[0], exc_info[1], exc_info[2]
+    return results
+
+
+def _merge(results, order, limit, offset):
+    rows = [row for shard in sorted(results) for row in results[shard]]
+    if order:
+        rows = _sort(rows, order)
+    start = offset or 0
+    return rows[start:start + limit] if limit else rows[start:]
+
+
+def query_all(sql, params=None, order=None, limit=None, offset=None, **options):
+    """
+        Run 'sql' on every shard and merge the rows. When 'order' is given
+        (same format of select, eg. ('name', 'id__desc')) the merged rows are
+        sorted, and 'limit'/'offset' are applied to the merged result.
+    """
+    return _merge(scatter('query', sql, params, connection_options=options), order, limit, offset)
+
+
+def select_all(table, where=None, order=None, columns=None, limit=None, offset=None, **options):
+    """
+        Select from 'table' on every shard and merge the rows, sorted by
+        'order'. The limit is pushed down to each shard as LIMIT limit+offset,
+        and limit/offset are applied again to the merged rows.
+
+        >>> select_all('t1', where={'active': True}, order=('created__desc',), limit=20)
+    """
+    shard_limit = limit + (offset or 0) if limit else None
+    results = scatter('select', table, where, order, columns, shard_limit, connection_options=options)
+    return _merge(results, order, limit, offset)
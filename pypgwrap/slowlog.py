@@ -0,0 +1,121 @@
+__author__ = 'Erick Almeida'
+
+import Queue
+import re
+import threading
+import time
+from collections import OrderedDict
+from profiler import fingerprint
+
+_explainable = re.compile(r'^\s*(select|insert|update|delete|with|values)\b', re.IGNORECASE)
+
+
+class SlowQueryLog(object):
+    """
+        Captures statements slower than 'threshold' seconds and records their
+        plan (EXPLAIN (FORMAT JSON)) in a ring buffer of the last 'size'
+        distinct fingerprints. Plans are collected asynchronously on a
+        separate connection of the pool the statement ran on ('pool', then
+        the default pool, when unknown). With 'analyze' the statement is run again
+        (EXPLAIN ANALYZE) inside a transaction which is always rolled back.
+
+        >>> slow_log = SlowQueryLog(threshold=0.5)
+        >>> pypgwrap.config_pool(url='postgres://localhost/', slow_query_log=slow_log)
+        >>> slow_log.entries()[0]['plan']
+        [{'Plan': {'Node Type': 'Seq Scan', ...}}]
+    """
+
+    def __init__(self, threshold=1.0, size=100, analyze=False, pool=None, queue_size=100):
+        self.threshold = threshold
+        self.size = size
+        self.analyze = analyze
+        self.pool = pool
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._queue = Queue.Queue(maxsize=queue_size)
+        self._thread = None
+
+    def capture(self, query, duration, pool=None):
+        """Register a slow execution on 'pool', scheduling its EXPLAIN if the fingerprint is new."""
+        fp = fingerprint(query)
+        with self._lock:
+            entry = self._entries.get(fp)
+            if entry is not None:
+                entry['count'] += 1
+                entry['duration'] = max(entry['duration'], duration)
+                entry['timestamp'] = time.time()
+                del self._entries[fp]
+                self._entries[fp] = entry
+                return
+            self._entries[fp] = {'fingerprint': fp,
+                                 'query': query,
+                                 'duration': duration,
+                                 'count': 1,
+                                 'timestamp': time.time(),
+                                 'plan': None,
+                                 'error': None}
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+        try:
+            self._queue.put_nowait((fp, pool))
+        except Queue.Full:
+            pass
+
+    def entries(self):
+        """Return the captured entries, most recent first."""
+        with self._lock:
+            return [dict(e) for e in reversed(self._entries.values())]
+
+    def get(self, fp):
+        with self._lock:
+            entry = self._entries.get(fp)
+            return dict(entry) if entry is not None else None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _run(self):
+        while True:
+            fp, pool = self._queue.get()
+            with self._lock:
+                entry = self._entries.get(fp)
+                query = entry and entry['query']
+            if query is None:
+                continue
+            try:
+                plan, error = self._explain(query, pool), None
+            except Exception as e:
+                plan, error = None, str(e)
+            with self._lock:
+                if fp in self._entries:
+                    self._entries[fp]['plan'] = plan
+                    self._entries[fp]['error'] = error
+
+    def _explain(self, query, pool=None):
+        if not _explainable.match(query):
+            raise ValueError('statement can not be explained')
+        pool = pool or self.pool
+        if pool is None:
+            from connection import get_pool
+            pool = get_pool()
+        conn = pool.getconn()
+        try:
+            autocommit = conn.autocommit
+            conn.autocommit = False
+            try:
+                cur = conn.cursor()
+                try:
+                    cur.execute('EXPLAIN (%sFORMAT JSON) %s' % ('ANALYZE, ' if self.analyze else '', query))
+                    return cur.fetchone()[0]
+                finally:
+                    cur.close()
+            finally:
+                conn.rollback()
+                conn.autocommit = autocommit
+        finally:
+            pool.putconn(conn)
@@ -0,0 +1,314 @@
+__author__ = 'Erick Almeida'
+
+import base64
+import datetime
+import decimal
+import errno
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import uuid
+from psycopg2.tz import FixedOffsetTimezone
+from connection import connection
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+MAGIC = 'PGWSNAP2'
+_HEADER = struct.Struct('<Q')
+
+
+def _offset(value):
+    offset = value.utcoffset()
+    return None if offset is None else offset.days * 1440 + offset.seconds // 60
+
+
+def _tz(offset):
+    return None if offset is None else FixedOffsetTimezone(offset=offset)
+
+
+def _encode(value):
+    """
+        Convert 'value' to plain JSON data. Snapshot files are shared, so they
+        hold data only (never pickles): other types are tagged as one key
+        objects, eg. {"date": [2020, 1, 31]}, plain dicts included.
+    """
+    if value is None or isinstance(value, (bool, int, long, float)):
+        return value
+    if isinstance(value, str):
+        try:
+            value.decode('utf-8')
+            return value
+        except UnicodeDecodeError:
+            return {'bytes': base64.b64encode(value)}
+    if isinstance(value, unicode):
+        return {'unicode': value}
+    if isinstance(value, list):
+        return [_encode(v) for v in value]
+    if isinstance(value, tuple):
+        return {'tuple': [_encode(v) for v in value]}
+    if isinstance(value, dict):
+        return {'dict': [[_encode(k), _encode(v)] for k, v in value.iteritems()]}
+    if isinstance(value, datetime.datetime):
+        return {'datetime': [value.year, value.month, value.day, value.hour, value.minute, value.second,
+                             value.microsecond, _offset(value)]}
+    if isinstance(value, datetime.date):
+        return {'date': [value.year, value.month, value.day]}
+    if isinstance(value, datetime.time):
+        return {'time': [value.hour, value.minute, value.second, value.microsecond, _offset(value)]}
+    if isinstance(value, datetime.timedelta):
+        return {'timedelta': [value.days, value.seconds, value.microseconds]}
+    if isinstance(value, decimal.Decimal):
+        return {'decimal': str(value)}
+    if isinstance(value, uuid.UUID):
+        return {'uuid': str(value)}
+    if isinstance(value, (buffer, bytearray)):
+        return {'buffer': base64.b64encode(value)}
+    raise TypeError('%s values can not be written to a snapshot' % type(value).__name__)
+
+
+_decoders = {
+    'bytes': base64.b64decode,
+    'unicode': lambda v: v,
+    'tuple': lambda v: tuple(_decode(i) for i in v),
+    'dict': lambda v: dict((_decode(k), _decode(i)) for k, i in v),
+    'datetime': lambda v: datetime.datetime(*v[:7], tzinfo=_tz(v[7])),
+    'date': lambda v: datetime.date(*v),
+    'time': lambda v: datetime.time(*v[:4], tzinfo=_tz(v[4])),
+    'timedelta': lambda v: datetime.timedelta(*v),
+    'decimal': decimal.Decimal,
+    'uuid': uuid.UUID,
+    'buffer': lambda v: buffer(base64.b64decode(v)),
+}
+
+
+def _decode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [_decode(v) for v in value]
+    if isinstance(value, dict):
+        (tag, data), = value.items()
+        return _decoders[tag](data)
+    return value
+
+
+def _dumps(value):
+    return json.dumps(_encode(value), separators=(',', ':'))
+
+
+def _loads(data):
+    return _decode(json.loads(data))
+
+
+class Snapshot(object):
+    """
+        Read-only view of a snapshot file, memory mapped so the pages are
+        shared by every process reading it. Rows are decoded on access and
+        returned as dicts (column -> value), looked up by the snapshot key.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.inode = os.fstat(f.fileno()).st_ino
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            raise ValueError('%s is not a snapshot file' % path)
+        start = len(MAGIC) + _HEADER.size
+        meta_length = _HEADER.unpack(self._map[len(MAGIC):start])[0]
+        meta = _loads(self._map[start:start + meta_length])
+        self.path = path
+        self.version = meta['version']
+        self.columns = meta['columns']
+        self.created = meta['created']
+        self._index = dict((key, (offset, length)) for key, offset, length in meta['index'])
+        self._base = start + meta_length
+
+    def _row(self, (offset, length)):
+        start = self._base + offset
+        return dict(zip(self.columns, _loads(self._map[start:start + length])))
+
+    def __getitem__(self, key):
+        return self._row(self._index[key])
+
+    def get(self, key, default=None):
+        position = self._index.get(key)
+        return default if position is None else self._row(position)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def keys(self):
+        return self._index.keys()
+
+    def rows(self):
+        """Iterate over the rows in query order."""
+        return (self._row(position) for position in sorted(self._index.values()))
+
+
+def write_snapshot(path, version, columns, rows, key=None):
+    """
+        Write 'rows' (sequences in 'columns' order) to the snapshot file
+        'path', indexed by column 'key' (row number if None). The file is
+        replaced atomically, readers keep the mapped previous version.
+    """
+    key_index = columns.index(key) if key is not None else None
+    index, chunks, offset = [], [], 0
+    for i, row in enumerate(rows):
+        data = _dumps(list(row))
+        index.append((row[key_index] if key_index is not None else i, offset, len(data)))
+        chunks.append(data)
+        offset += len(data)
+    meta = _dumps({'version': version, 'columns': list(columns), 'index': index, 'created': time.time()})
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC)
+        f.write(_HEADER.pack(len(meta)))
+        f.write(meta)
+        f.writelines(chunks)
+    os.rename(tmp, path)
+
+
+class SnapshotCache(object):
+    """
+        On-disk snapshots of query results (eg. reference tables) shared by
+        every process of the host through memory mapped files in 'directory'.
+        A process starting with the file already written gets the data
+        without running the query.
+
+        Each snapshot has a 'version' query returning a single value (eg. the
+        max(updated_at) of the table): it is checked when the snapshot is
+        first used and every 'refresh_interval' seconds by the background
+        thread, and the snapshot is rebuilt (by one process, under a file
+        lock) when the value changes. Without a version query the snapshot is
+        rebuilt when older than 'refresh_interval'. Refresh errors are passed
+        to on_error(name, exc_info) and the previous snapshot is kept. The
+        file lock needs fcntl, so it is not available on Windows.
+
+        >>> cache = SnapshotCache('/var/cache/app', refresh_interval=30)
+        >>> cache.register('countries', 'SELECT * FROM countries', key='code',
+        ...                version='SELECT max(updated_at) FROM countries')
+        >>> cache.start()
+        >>> cache.get('countries')['BR']
+        {'code': 'BR', 'name': 'Brazil', 'updated_at': datetime.datetime(...)}
+        >>> cache.stop()
+    """
+
+    def __init__(self, directory, refresh_interval=60.0, on_error=None, **connection_options):
+        if fcntl is None:
+            raise NotImplementedError('SnapshotCache needs fcntl file locks')
+        self.directory = directory
+        self.refresh_interval = refresh_interval
+        self.on_error = on_error
+        self.connection_options = connection_options
+        self._sources = {}  # name -> (sql, params, key, version)
+        self._snapshots = {}  # name -> Snapshot
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def register(self, name, sql, key=None, params=None, version=None):
+        """Register snapshot 'name' with the rows of 'sql', indexed by column 'key'."""
+        self._sources[name] = (sql, params, key, version)
+
+    def path(self, name):
+        return os.path.join(self.directory, name + '.snapshot')
+
+    def get(self, name):
+        """Return the current Snapshot 'name', loading (or building) it on first use."""
+        snapshot = self._snapshots.get(name)
+        if snapshot is None:
+            with self._lock:
+                snapshot = self._snapshots.get(name)
+                if snapshot is None:
+                    snapshot = self._snapshots[name] = self._refresh(name, None)
+        return snapshot
+
+    def refresh(self, name=None):
+        """Check the version of snapshot 'name' (every one if None), rebuilding it if changed."""
+        for name in [name] if name else list(self._sources):
+            current = self._snapshots.get(name)
+            snapshot = self._refresh(name, current)
+            if snapshot is not current:
+                with self._lock:
+                    self._snapshots[name] = snapshot
+
+    def start(self):
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stopped.wait(self.refresh_interval):
+            for name in list(self._snapshots):
+                try:
+                    self.refresh(name)
+                except Exception:
+                    if self.on_error:
+                        self.on_error(name, sys.exc_info())
+
+    def _open(self, name):
+        try:
+            return Snapshot(self.path(name))
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+        except ValueError:
+            pass
+        return None
+
+    def _valid(self, snapshot, version, query):
+        if snapshot is None:
+            return False
+        if query is None:
+            return time.time() - snapshot.created < self.refresh_interval
+        return snapshot.version == version
+
+    def _refresh(self, name, current):
+        sql, params, key, query = self._sources[name]
+        version = None
+        if query is not None:
+            with connection(**self.connection_options) as db:
+                version = db.query_one(query)[0]
+        if self._valid(current, version, query):
+            return current
+        # another process may have rebuilt it already
+        snapshot = self._open(name)
+        if snapshot is not None and current is not None and snapshot.inode == current.inode:
+            snapshot = current
+        if self._valid(snapshot, version, query):
+            return snapshot
+        with open(self.path(name) + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                snapshot = self._open(name)
+                if self._valid(snapshot, version, query):
+                    return snapshot
+                with connection(**self.connection_options) as db:
+                    with db.cursor() as c:
+                        if query is not None:
+                            # read before the rows: a change made meanwhile triggers another rebuild
+                            version = c.query_one(query)[0]
+                        rows = c.query(sql, params)
+                        columns = [d[0] for d in c.cursor.description]
+                write_snapshot(self.path(name), version, columns, rows, key)
+                return Snapshot(self.path(name))
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
@@ -41,12 +41,44 @@ def where(where):
         return ''
 
 
-def update(values):
+def having(having):
+    """
+        Construct HAVING clause from dict, in the same format as where (the
+        keys are usually aggregates):
+
+        eg. { count() + '__gt' : 1 }  ->  'count(*) > %(_having_0)s'
+
+        The values are passed as parameters, see having_params.
+    """
+    if having:
+        _having = []
+        for i, f in enumerate(sorted(having.keys())):
+            field, _, op = f.partition('__')
+            _having.append('%s %s %%(_having_%d)s' % (field, _operators.get(op, op) or '=', i))
+        return ' HAVING ' + ' AND '.join(_having)
+    else:
+        return ''
+
+
+def having_params(having, params=None):
+    """Return 'params' (eg. the where dict) with the values of the having clause added."""
+    if having:
+        params = dict(params or {})
+        for i, f in enumerate(sorted(having.keys())):
+            params['_having_%d' % i] = having[f]
+    return params
+
+
+def update(values, types=None):
+    """
+        Construct SET clause from dict (see _update_operators). Plain
+        assignments are cast to types[field] when 'types' is given.
+    """
     _update = []
     for k, v in values.items():
         f, _, op = k.partition('__')
         _update.append(_update_operators[op] %
-                       {'key': k, 'val': v, 'field': f, 'op': op})
+                       {'key': k, 'val': v, 'field': f, 'op': op} + ('::' + types[f] if types and not op else ''))
     return ','.join(_update)
 
 
@@ -61,6 +93,27 @@ def order(order):
         return ''
 
 
+def group_by(group_by):
+    if isinstance(group_by, (str, unicode)):
+        group_by = (group_by,)
+    if group_by:
+        return ' GROUP BY ' + ', '.join(group_by)
+    else:
+        return ''
+
+
+def aggregate(function, field='*', distinct=False, order_by=None):
+    """
+        Aggregate expression, to be used in columns or having:
+
+            columns = ('name', (aggregate('count'), 'n'), (aggregate('array_agg', 'id', order_by='id__desc'), 'ids'))
+            having = {aggregate('sum', 'value') + '__gt': 10}
+    """
+    if isinstance(order_by, (str, unicode)):
+        order_by = (order_by,)
+    return '%s(%s%s%s)' % (function, 'DISTINCT ' if distinct else '', field, order(order_by))
+
+
 def columns(columns):
     if columns:
         return ", ".join([(c if isinstance(c, (str, unicode))
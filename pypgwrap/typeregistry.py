@@ -0,0 +1,96 @@
+__author__ = 'Erick Almeida'
+
+import threading
+import psycopg2
+import psycopg2.extensions as _ext
+import psycopg2.extras
+
+_hstore_oids = {}  # dsn -> (oids, array oids)
+
+JSON_OID, JSON_ARRAY_OID = 114, 199
+JSONB_OID, JSONB_ARRAY_OID = 3802, 3807
+
+
+def hstore_oids(conn):
+    """Return the hstore (oids, array oids) of the database of 'conn', querying the catalog once."""
+    oids = _hstore_oids.get(conn.dsn)
+    if oids is None:
+        oids = _hstore_oids[conn.dsn] = psycopg2.extras.HstoreAdapter.get_oids(conn)
+    return oids
+
+
+def register_hstore(conn_or_curs):
+    """Same as psycopg2.extras.register_hstore, using the cached OIDs."""
+    conn = conn_or_curs.connection if isinstance(conn_or_curs, _ext.cursor) else conn_or_curs
+    oids, array_oids = hstore_oids(conn)
+    if not oids:
+        raise psycopg2.ProgrammingError("hstore type not found in the database; please install it")
+    psycopg2.extras.register_hstore(conn_or_curs, oid=oids, array_oid=array_oids)
+
+
+class TypeRegistry(object):
+    """
+        Types registered on every physical connection of the pool. The type
+        OIDs are resolved from the catalog on the first connection to each
+        database (dsn) and reused, so custom types add no round trip per
+        connection or query, and a registry can be shared by shard pools.
+
+        hstore      : register hstore (and hstore[]) as dict
+        json_loads  : function used to load json/jsonb values
+        composites  : composite type names (or (name, CompositeCaster subclass))
+                      returned as namedtuples
+        enums       : enum type names, or dict name -> function converting the
+                      value (eg. an Enum class); enum arrays are returned as lists
+
+        >>> pypgwrap.config_pool(url='postgres://localhost/',
+        ...                      type_registry=TypeRegistry(hstore=True, composites=('address',),
+        ...                                                 enums={'mood': Mood}))
+    """
+
+    def __init__(self, hstore=False, json_loads=None, composites=(), enums=()):
+        self.hstore = hstore
+        self.json_loads = json_loads
+        self.composites = composites
+        self.enums = enums if isinstance(enums, dict) else dict.fromkeys(enums)
+        self._lock = threading.Lock()
+        self._casters = {}  # dsn -> typecasters
+
+    def _resolve(self, conn):
+        with self._lock:
+            casters = self._casters.get(conn.dsn)
+            if casters is None:
+                casters = []
+                for composite in self.composites:
+                    name, factory = composite if isinstance(composite, tuple) \
+                        else (composite, psycopg2.extras.CompositeCaster)
+                    caster = factory._from_db(name, conn)
+                    casters.append(caster.typecaster)
+                    if caster.array_typecaster is not None:
+                        casters.append(caster.array_typecaster)
+                cur = conn.cursor()
+                try:
+                    for name, cast in self.enums.items():
+                        cur.execute('SELECT oid, typarray FROM pg_type WHERE oid = %s::regtype', (name,))
+                        oid, array_oid = cur.fetchone()
+                        if cast is None:
+                            typecaster = _ext.new_type((oid,), name, psycopg2.STRING)
+                        else:
+                            typecaster = _ext.new_type((oid,), name,
+                                                       lambda value, cursor, cast=cast:
+                                                       cast(value) if value is not None else None)
+                        casters.append(typecaster)
+                        casters.append(_ext.new_array_type((array_oid,), name + '[]', typecaster))
+                finally:
+                    cur.close()
+                self._casters[conn.dsn] = casters
+            return casters
+
+    def register(self, conn):
+        """Register the types on the psycopg2 connection 'conn'."""
+        for typecaster in self._resolve(conn):
+            _ext.register_type(typecaster, conn)
+        if self.hstore:
+            register_hstore(conn)
+        if self.json_loads:
+            psycopg2.extras.register_json(conn, loads=self.json_loads, oid=JSON_OID, array_oid=JSON_ARRAY_OID)
+            psycopg2.extras.register_json(conn, loads=self.json_loads, oid=JSONB_OID, array_oid=JSONB_ARRAY_OID)
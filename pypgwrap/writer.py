@@ -0,0 +1,201 @@
+__author__ = 'Erick Almeida'
+
+import atexit
+import cStringIO
+import json
+import Queue
+import sys
+import threading
+import time
+import weakref
+from connection import connection
+
+_writers = weakref.WeakSet()
+
+
+class BufferFullError(Exception):
+    pass
+
+
+class _Marker(object):
+    """Queued after the rows to flush; 'done' is set once they are written."""
+
+    def __init__(self, stop=False):
+        self.stop = stop
+        self.done = threading.Event()
+
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, float):
+        # str() rounds to 12 significant digits in python 2
+        value = repr(value)
+    elif isinstance(value, dict):
+        # json/jsonb columns
+        value = json.dumps(value)
+    elif isinstance(value, (list, tuple, set)):
+        raise TypeError('COPY cannot send %s values, use method=\'insert\'' % type(value).__name__)
+    elif isinstance(value, unicode):
+        value = value.encode('utf-8')
+    elif not isinstance(value, str):
+        value = str(value)
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class BufferedWriter(object):
+    """
+        Write-behind inserter bound to 'table'. write() only queues the row;
+        a background thread inserts the queued rows in bulk (one multi-row
+        INSERT, or COPY with method='copy') when 'batch_size' rows are queued
+        or 'flush_interval' seconds after the first one, each batch in its own
+        transaction on a pooled connection (created with 'connection_options').
+
+        At most 'max_buffer' rows are queued: write() then blocks up to
+        'block_timeout' seconds (forever if None, not at all if 0) and raises
+        BufferFullError. Failed batches are passed to on_error(rows, exc_info)
+        and counted in 'failed'. Queued rows are flushed by flush(), close()
+        and at interpreter exit.
+
+        Rows are dicts, or sequences in 'columns' order. COPY sends values in
+        text format, dicts as json, so arrays and hstore values need
+        method='insert' (with COPY, lists and tuples fail the batch with
+        TypeError).
+
+        >>> writer = BufferedWriter('audit', batch_size=1000, flush_interval=0.5,
+        ...                         on_error=lambda rows, exc_info: log.error('lost %d rows', len(rows)))
+        >>> writer.write({'user_id': 1, 'action': 'login'})
+        >>> writer.flush()
+        >>> writer.written
+        1
+        >>> writer.close()
+    """
+
+    def __init__(self, table, columns=None, batch_size=500, flush_interval=1.0, max_buffer=10000,
+                 block_timeout=None, method='insert', on_error=None, **connection_options):
+        if method not in ('insert', 'copy'):
+            raise ValueError("method must be 'insert' or 'copy'")
+        self.table = table
+        self.columns = tuple(columns) if columns else None
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.block_timeout = block_timeout
+        self.method = method
+        self.on_error = on_error
+        self.connection_options = connection_options
+        self.written = 0
+        self.failed = 0
+        self.closed = False
+        self._queue = Queue.Queue(max_buffer)
+        self._lock = threading.Lock()
+        self._thread = None
+        _writers.add(self)
+
+    def write(self, row):
+        """Queue 'row' to be inserted; raises BufferFullError if the buffer stays full."""
+        if self.closed:
+            raise ValueError('write to a closed BufferedWriter')
+        if self.columns is None and not isinstance(row, dict):
+            raise ValueError("'columns' is required to write sequences")
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put(row, self.block_timeout != 0, self.block_timeout or None)
+        except Queue.Full:
+            raise BufferFullError('%d rows waiting to be written to %s' % (self._queue.maxsize, self.table))
+
+    def flush(self):
+        """Wait until the rows queued so far are written (or failed)."""
+        if self._thread is not None:
+            marker = _Marker()
+            self._queue.put(marker)
+            marker.done.wait()
+
+    def close(self):
+        """Flush the queued rows and stop the background thread."""
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            thread = self._thread
+        if thread is not None:
+            marker = _Marker(stop=True)
+            self._queue.put(marker)
+            marker.done.wait()
+            thread.join()
+            self._thread = None
+
+    def pending(self):
+        """Approximate number of queued rows."""
+        return self._queue.qsize()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None and not self.closed:
+                self._thread = threading.Thread(target=self._run, name='BufferedWriter(%s)' % self.table)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        rows = []
+        deadline = None
+        while True:
+            try:
+                if deadline is None:
+                    item = self._queue.get()
+                else:
+                    item = self._queue.get(True, max(deadline - time.time(), 0.001))
+            except Queue.Empty:
+                item = None  # flush_interval elapsed
+            if item is not None and not isinstance(item, _Marker):
+                if not rows:
+                    deadline = time.time() + self.flush_interval
+                rows.append(item)
+                if len(rows) < self.batch_size:
+                    continue
+            if rows:
+                self._flush(rows)
+                rows = []
+                deadline = None
+            if isinstance(item, _Marker):
+                item.done.set()
+                if item.stop:
+                    return
+
+    def _flush(self, rows):
+        batches = {}
+        for row in rows:
+            columns = self.columns or tuple(sorted(row))
+            batches.setdefault(columns, []).append(row)
+        for columns, batch in batches.items():
+            try:
+                with connection(**self.connection_options) as db:
+                    if self.method == 'copy':
+                        self._copy(db, columns, batch)
+                    else:
+                        db.insert_many(self.table, batch, columns)
+                self.written += len(batch)
+            except Exception:
+                self.failed += len(batch)
+                if self.on_error:
+                    try:
+                        self.on_error(batch, sys.exc_info())
+                    except Exception:
+                        pass
+
+    def _copy(self, db, columns, rows):
+        buf = cStringIO.StringIO()
+        for row in rows:
+            values = [row.get(c) for c in columns] if isinstance(row, dict) else row
+            buf.write('\t'.join([_copy_value(v) for v in values]) + '\n')
+        buf.seek(0)
+        with db.cursor() as c:
+            c.cursor.copy_expert('COPY %s (%s) FROM STDIN' % (self.table, ','.join(columns)), buf)
+
+
+@atexit.register
+def _close_writers():
+    for writer in list(_writers):
+        writer.close()
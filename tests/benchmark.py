@@ -0,0 +1,230 @@
+"""
+    pypgwrap benchmark suite
+
+    Runs against a throwaway PostgreSQL cluster created with initdb/pg_ctl in
+    a temporary directory (the binaries must be on PATH or in --pg-bin) and
+    writes the results as JSON. When a baseline file is given, any benchmark
+    slower than the baseline by more than --threshold fails the run.
+
+        python -m tests.benchmark --output bench.json
+        python -m tests.benchmark --baseline bench.json --threshold 0.2
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+__author__ = 'Erick Almeida'
+
+
+class Benchmarks(object):
+    """Registry of named benchmark callables, each returning the number of operations run."""
+
+    def __init__(self):
+        self.items = []
+
+    def add(self, name, func, *args, **kwargs):
+        self.items.append((name, func, args, kwargs))
+
+    def run(self, repeat=5, only=None):
+        results = {}
+        for name, func, args, kwargs in self.items:
+            if only and only not in name:
+                continue
+            timings = []
+            ops = 0
+            for _ in range(repeat):
+                start = time.time()
+                ops = func(*args, **kwargs)
+                timings.append((time.time() - start) * 1e6 / ops)
+            timings.sort()
+            results[name] = {'ops': ops,
+                             'median_us': timings[len(timings) // 2],
+                             'min_us': timings[0]}
+            sys.stderr.write('%-45s %12.2f us/op\n' % (name, results[name]['median_us']))
+        return results
+
+
+def compare(results, baseline, threshold):
+    """Return the benchmarks slower than 'baseline' by more than 'threshold' (ratio)."""
+    regressions = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if base and result['median_us'] > base['median_us'] * (1 + threshold):
+            regressions.append((name, base['median_us'], result['median_us']))
+    return regressions
+
+
+def main(benchmarks, argv=None, setup=None, teardown=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--baseline', help='JSON results to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown ratio (default 0.2)')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', help='run only benchmarks containing this text')
+    parser.add_argument('--pg-bin', default='', help='directory of initdb/pg_ctl')
+    args = parser.parse_args(argv)
+
+    state = setup(args) if setup else None
+    try:
+        results = benchmarks.run(args.repeat, args.only)
+    finally:
+        if teardown:
+            teardown(state)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for name, base, current in regressions:
+            sys.stderr.write('REGRESSION %s: %.2f us -> %.2f us\n' % (name, base, current))
+        if regressions:
+            return 1
+    return 0
+
+
+class LocalPostgres(object):
+    """Throwaway PostgreSQL cluster in a temporary directory."""
+
+    def __init__(self, pg_bin=''):
+        self.pg_bin = pg_bin
+        self.datadir = tempfile.mkdtemp(prefix='pypgwrap_bench_')
+        self.port = self._free_port()
+
+    def _bin(self, name):
+        return os.path.join(self.pg_bin, name) if self.pg_bin else name
+
+    def _free_port(self):
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+        s.close()
+        return port
+
+    @property
+    def url(self):
+        return 'postgres://postgres@127.0.0.1:%d/postgres' % self.port
+
+    def start(self):
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call([self._bin('initdb'), '-D', self.datadir, '-U', 'postgres', '-A', 'trust'],
+                                  stdout=devnull, stderr=devnull)
+            subprocess.check_call([self._bin('pg_ctl'), '-D', self.datadir, '-w', '-l',
+                                   os.path.join(self.datadir, 'server.log'), '-o',
+                                   "-p %d -k %s -c listen_addresses=127.0.0.1 -c max_connections=100 "
+                                   "-c fsync=off" % (self.port, self.datadir), 'start'],
+                                  stdout=devnull, stderr=devnull)
+
+    def stop(self):
+        with open(os.devnull, 'w') as devnull:
+            subprocess.call([self._bin('pg_ctl'), '-D', self.datadir, '-m', 'immediate', 'stop'],
+                            stdout=devnull, stderr=devnull)
+        shutil.rmtree(self.datadir, ignore_errors=True)
+
+
+def _pool_checkout(threads, loops):
+    from pypgwrap.connection import get_pool
+    pool = get_pool()
+
+    def _run():
+        for _ in range(loops):
+            conn = pool.getconn()
+            pool.putconn(conn)
+
+    workers = [threading.Thread(target=_run) for _ in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return threads * loops
+
+
+def _connection(loops):
+    from pypgwrap import connection
+    for _ in range(loops):
+        connection().close()
+    return loops
+
+
+def _select(method, size, loops):
+    from pypgwrap import connection
+    db = connection()
+    try:
+        for _ in range(loops):
+            if method == 'query_dict':
+                db.query_dict('SELECT * FROM bench_t1 WHERE id <= %s', 'id', (size,))
+            else:
+                getattr(db, method)('bench_t1', where={'id__<=': size})
+    finally:
+        db.close()
+    return loops
+
+
+def _insert_single(rows):
+    from pypgwrap import connection
+    with connection() as db:
+        for i in range(rows):
+            db.insert('bench_t2', {'name': 'row%d' % i, 'count': i})
+    return rows
+
+
+def _insert_bulk(rows):
+    from pypgwrap import connection
+    with connection() as db:
+        with db.cursor() as c:
+            values = ','.join(c.cursor.mogrify('(%s,%s)', ('row%d' % i, i)) for i in range(rows))
+            c.execute('INSERT INTO bench_t2 (name, count) VALUES ' + values)
+    return rows
+
+
+def _update(loops):
+    from pypgwrap import connection
+    with connection() as db:
+        for i in range(loops):
+            db.update('bench_t1', {'count__add': 1}, where={'id': i % 100 + 1})
+    return loops
+
+
+def _setup(args):
+    import pypgwrap
+    from pypgwrap.pool import ThreadedConnectionPool
+
+    server = LocalPostgres(args.pg_bin)
+    server.start()
+    pypgwrap.config_pool(max_pool=64, pool_expiration=10, url=server.url, pool_manager=ThreadedConnectionPool)
+    with pypgwrap.connection() as db:
+        db.create_table('bench_t1', 'id SERIAL PRIMARY KEY, name TEXT NOT NULL, count INTEGER NOT NULL DEFAULT 0')
+        db.create_table('bench_t2', 'id SERIAL PRIMARY KEY, name TEXT NOT NULL, count INTEGER NOT NULL DEFAULT 0')
+        db.execute("INSERT INTO bench_t1 (name) SELECT 'name' || i FROM generate_series(1, 10000) i")
+    return server
+
+
+def _teardown(server):
+    from pypgwrap.connection import get_pool
+    try:
+        get_pool().closeall()
+    finally:
+        server.stop()
+
+
+benchmarks = Benchmarks()
+for _threads in (1, 8, 64):
+    benchmarks.add('pool.checkout[threads=%d]' % _threads, _pool_checkout, _threads, 2000 // _threads)
+benchmarks.add('connection()', _connection, 1000)
+for _method in ('select', 'select_one', 'query_dict'):
+    for _size in (1, 100, 10000):
+        benchmarks.add('%s[rows=%d]' % (_method, _size), _select, _method, _size, max(10, 10000 // _size))
+benchmarks.add('insert[single]', _insert_single, 1000)
+benchmarks.add('insert[bulk]', _insert_bulk, 1000)
+benchmarks.add('update[count__add]', _update, 1000)
+
+if __name__ == '__main__':
+    sys.exit(main(benchmarks, setup=_setup, teardown=_teardown))
@@ -0,0 +1,113 @@
+"""
+    pypgwrap overhead micro-benchmarks
+
+    Measures the Python overhead of the public API per call (in microseconds)
+    using the in-memory FakeDriver instead of psycopg2, so no database is
+    needed. 'fake.*' entries time the fake driver alone, as reference for the
+    wrapper overhead. Accepts the same options as tests/benchmark.py.
+
+        python -m tests.benchmark_overhead --output overhead.json
+        python -m tests.benchmark_overhead --baseline overhead.json --threshold 0.2
+"""
+import sys
+
+__author__ = 'Erick Almeida'
+
+import pypgwrap
+from pypgwrap import sqlop
+from pypgwrap.fakedriver import FakeDriver
+from pypgwrap.pool import SimpleConnectionPool
+from pypgwrap.profiler import Profiler
+from tests.benchmark import Benchmarks, main
+
+LOOPS = 10000
+WHERE = {'name': 'abc', 'count__gt': 10, 'id__in': (1, 2, 3)}
+
+
+class _NullLog(object):
+    def write(self, msg):
+        pass
+
+
+class _Row(object):
+    __slots__ = ('id', 'name', 'count')
+
+
+def _loop(func, *args, **kwargs):
+    for _ in xrange(LOOPS):
+        func(*args, **kwargs)
+    return LOOPS
+
+
+def _connection():
+    pypgwrap.connection().close()
+
+
+def _cursor(db):
+    with db.cursor():
+        pass
+
+
+def _fake(db):
+    cur = db.connection.cursor()
+    cur.execute('SELECT * FROM t1')
+    cur.fetchall()
+    cur.close()
+
+
+def _setup(args):
+    driver = FakeDriver(rows=[(i, 'name%d' % i, i % 10) for i in range(10)], columns=('id', 'name', 'count'))
+    pypgwrap.config_pool(max_pool=10, pool_manager=SimpleConnectionPool, driver=driver)
+    db = pypgwrap.connection()
+    logged = pypgwrap.connection(log=_NullLog())
+    profiled = pypgwrap.connection(profiler=Profiler())
+    cached = pypgwrap.connection(cached_cursor=True)
+    prepared = db.prepare('SELECT * FROM t1 WHERE id = $1')
+
+    add = benchmarks.add
+    add('fake.execute', _loop, _fake, db)
+    add('connection()', _loop, _connection)
+    add('connection.cursor', _loop, _cursor, db)
+    add('connection.commit', _loop, db.commit)
+    add('connection.rollback', _loop, db.rollback)
+    add('execute', _loop, db.execute, 'SELECT 1')
+    add('query', _loop, db.query, 'SELECT * FROM t1')
+    add('query_one', _loop, db.query_one, 'SELECT * FROM t1 WHERE id = %s', (1,))
+    add('query_dict', _loop, db.query_dict, 'SELECT * FROM t1', 0)
+    add('query_as', _loop, db.query_as, _Row, 'SELECT * FROM t1')
+    add('select', _loop, db.select, 't1', where=WHERE, order=('name__desc',), limit=10)
+    add('select_one', _loop, db.select_one, 't1', where=WHERE)
+    add('select_dict', _loop, db.select_dict, 't1', 0, where=WHERE)
+    add('join', _loop, db.join, ('t1', 't2'), where=WHERE)
+    add('join_one', _loop, db.join_one, ('t1', 't2'), where=WHERE)
+    add('join_dict', _loop, db.join_dict, ('t1', 't2'), 0, where=WHERE)
+    add('count', _loop, db.count, 't1', where=WHERE)
+    add('exists', _loop, db.exists, 't1', where=WHERE)
+    add('insert', _loop, db.insert, 't1', {'name': 'abc', 'count': 1})
+    add('insert[returning]', _loop, db.insert, 't1', {'name': 'abc', 'count': 1}, returning='id')
+    add('update', _loop, db.update, 't1', {'name': 'xyz', 'count__add': 1}, where=WHERE)
+    add('delete', _loop, db.delete, 't1', where=WHERE)
+    add('check_table', _loop, db.check_table, 't1')
+    add('create_table', _loop, db.create_table, 't1', 'id serial')
+    add('drop_table', _loop, db.drop_table, 't1')
+    add('prepared_statement', _loop, prepared, 1)
+    add('select[log]', _loop, logged.select, 't1', where=WHERE)
+    add('select[profiler]', _loop, profiled.select, 't1', where=WHERE)
+    add('select[cached_cursor]', _loop, cached.select, 't1', where=WHERE)
+    add('insert[cached_cursor]', _loop, cached.insert, 't1', {'name': 'abc', 'count': 1})
+    add('sqlop.where', _loop, sqlop.where, WHERE)
+    add('sqlop.update', _loop, sqlop.update, {'name': 'xyz', 'count__add': 1})
+    add('sqlop.order', _loop, sqlop.order, ('name__desc', 'id'))
+    add('sqlop.columns', _loop, sqlop.columns, ('name', ('count > 1', 'many')))
+    return db, logged, profiled, cached
+
+
+def _teardown(state):
+    for db in state:
+        db.close()
+
+
+benchmarks = Benchmarks()
+
+if __name__ == '__main__':
+    sys.exit(main(benchmarks, setup=_setup, teardown=_teardown))